@@ -1,4 +1,8 @@
+__version__ = '0.1.0'
+
 from apgen.core import *
 from apgen.functions import *
 from apgen.autorender import *
 from apgen.qti_convert import *
+from apgen.bank import *
+from apgen.shard import *
@@ -0,0 +1,554 @@
+import html
+import math
+import os
+import pickle
+import time
+import zipfile
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from apgen.core import Question, Version, duplicate_key, question_name
+
+#----------------------------------------------------------------------
+# Worker-side helpers.
+# Questions hold code objects and cannot be pickled, so workers rebuild
+# them from the template (cheap when the template cache is enabled) and
+# keep them for the life of the process.
+#----------------------------------------------------------------------
+
+_worker_questions = {}
+
+def _worker_question(qt, cache_dir):
+    q = _worker_questions.get(qt)
+    if q is None:
+        q = Question(qt=qt, cache_dir=cache_dir)
+        _worker_questions[qt] = q
+    return q
+
+
+def _attempt_versions(q, seeds, report_errors):
+    '''
+    Attempts to generate one version for each seed provided. Returns the
+    successful versions along with the attempt counts and errors logged
+    while processing this batch.
+    '''
+    # Counts are collected separately for each batch, so set the question's
+    # totals aside while the batch runs.
+    saved = (q.attempt_counts, q.error_log)
+    q.attempt_counts = {'success':0, 'duplicate':0, 'error':0, 'condition':0}
+    q.error_log = {}
+
+    # generate_one changes the global seed, so save and restore the state.
+    np_state = np.random.get_state()
+    versions = []
+    for seed in seeds:
+        version = q.generate_one(int(seed), report_errors)
+        if version['status'] == 'Success':
+            versions.append(version)
+    np.random.set_state(np_state)
+
+    counts, error_log = q.attempt_counts, q.error_log
+    q.attempt_counts, q.error_log = saved
+    return versions, counts, error_log
+
+
+def _run_batch(qt, cache_dir, seeds, report_errors):
+    # The result is pickled here so that versions which cannot be pickled 
+    # (variables holding lambdas, modules, etc.) can be reported as None 
+    # rather than as an error. 
+    q = _worker_question(qt, cache_dir)
+    result = _attempt_versions(q, seeds, report_errors)
+    try:
+        return pickle.dumps(result)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+def _qti_items(q, versions, numbers, shuffle, seeds, perms, letters, fragments=False, compact=False):
+    '''
+    Returns the QTI item XML for a list of versions. numbers holds the position 
+    of each version in the package and is used for the item identifiers. 
+    perms and letters hold the answer shuffles for these versions. If fragments 
+    is True, the items are built for the item cache (see makeQTI.build_fragment). 
+    If compact is True, whitespace between tags is removed. 
+    '''
+    from apgen.qti_convert import makeQTI
+    
+    convertor = makeQTI(q, path='', shuffle=shuffle, shuffle_seed=0, compact=compact)
+    build = convertor.build_fragment if fragments else convertor.build_item
+    items = []
+    for n, version in enumerate(versions):
+        version.question = q
+        items.append(build(numbers[n], version, seeds, perms[n], letters[n]))
+    return items
+
+
+def _run_qti_batch(qt, cache_dir, versions, numbers, shuffle, seeds, perms, letters, fragments=False, compact=False, 
+                   css=False):
+    q = _worker_question(qt, cache_dir)
+    q.css_classes = css
+    return _qti_items(q, versions, numbers, shuffle, seeds, perms, letters, fragments, compact)
+
+
+class QuestionBank:
+
+    def __init__(self, questions, cache_dir=None):
+        '''
+        Class representing a collection of questions whose versions are
+        generated together under a shared attempt and time budget.
+
+        PARAMETERS
+        questions : list of Question objects
+        cache_dir : template cache directory used by worker processes
+        '''
+        self.questions = list(questions)
+        self.cache_dir = cache_dir
+        self.summary = []
+
+
+    def generate(self, n=1, seed=None, time_limit=None, max_attempts=1_000_000, prevent_duplicates=True,
+                 workers=None, batch_size=50, report_errors=False, verbose=True, question_attempts=100_000):
+
+        #-------------------------------------------------------------------------------------------------
+        #  Description: Creates versions for all questions in the bank
+        #-------------------------------------------------------------------------------------------------
+        #  Paramters:
+        #  n                  : Number of versions per question. Either an int or a list with one
+        #                       entry per question.
+        #  seed               : Seed for RNG
+        #  time_limit         : Time limit (in seconds) shared by all questions
+        #  max_attempts       : Total number of attempts shared by all questions
+        #  question_attempts  : Maximum number of attempts for any one question. This stops
+        #                       questions that have run out of distinct versions from using
+        #                       up the shared budget.
+        #  prevent_duplicates : If true, question texts are compared and repeats are discarded.
+        #  workers            : Number of worker processes. None uses one per CPU. 0 runs all
+        #                       attempts in the current process. Questions whose variables
+        #                       cannot be pickled (lambdas, modules) always run in the current
+        #                       process.
+        #  batch_size         : Maximum number of attempts sent to a worker at once.
+        #-------------------------------------------------------------------------------------------------
+        #  Batches are scheduled using the measured acceptance rate of each question. Questions
+        #  expected to finish in the fewest attempts are scheduled first, so easy templates
+        #  complete early and hard templates use whatever budget remains.
+        #
+        #  The seeds for each question are drawn from its own RNG, and batches are merged in the
+        #  order they were submitted. The versions kept therefore do not depend on the number of
+        #  workers or the batch size (unless the time limit or the budget is reached).
+        #-------------------------------------------------------------------------------------------------
+
+        num_q = len(self.questions)
+        targets = list(n) if hasattr(n, '__len__') else [n] * num_q
+        rng = np.random.RandomState(seed)
+
+        #-------------------------------------------------------------------
+        # Scheduling state for each question
+        #-------------------------------------------------------------------
+        state = []
+        for q, target in zip(self.questions, targets):
+            q.versions = []
+            q.num_attempts = 0
+            q.attempt_counts = {'success':0, 'duplicate':0, 'error':0, 'condition':0, 'surplus':0}
+            q.error_log = {}
+            state.append({
+                'target': min(target, q.max_versions),
+                'accepted': 0,          # Versions kept (after duplicate checks)
+                'attempts': 0,          # Attempts completed
+                'in_flight': 0,         # Attempts submitted but not completed
+                'seen': set(),          # Duplicate keys
+                'local': False,         # Generated in this process (see below)
+                'submitted': 0,         # Batches submitted
+                'merged': 0,            # Batches merged
+                'done': {},             # Completed batches waiting to be merged, by number
+                'rng': np.random.RandomState(rng.randint(2**31)),
+            })
+
+        #-------------------------------------------------------------------
+        # Helper functions for scheduling
+        #-------------------------------------------------------------------
+        def rate(s):
+            # Measured acceptance rate. Questions with no attempts yet are assumed 
+            # to accept every attempt, so the first batch is not larger than the 
+            # target. A weak prior is used until something has been accepted. 
+            if s['attempts'] == 0:
+                return 1.0
+            if s['accepted'] == 0:
+                return 1 / (s['attempts'] + 2)
+            return s['accepted'] / s['attempts']
+
+        def needed(s):
+            # Attempts still expected to be needed, excluding those in flight.
+            remaining = s['target'] - s['accepted']
+            allowed = question_attempts - s['attempts'] - s['in_flight']
+            return min(remaining / rate(s) - s['in_flight'], allowed)
+
+        def submit(i):
+            s = state[i]
+            allowed = question_attempts - s['attempts'] - s['in_flight']
+            size = int(min(batch_size, max(1, math.ceil(needed(s))), max_attempts - submitted[0], allowed))
+            seeds = (100000 * s['rng'].uniform(1, 10, size)).astype(int)
+
+            s['in_flight'] += size
+            submitted[0] += size
+
+            if pool is None or s['local']:
+                fut = Future()
+                fut.set_result(_attempt_versions(self.questions[i], seeds, report_errors))
+            else:
+                fut = pool.submit(_run_batch, self.questions[i].qt, self.cache_dir, seeds, report_errors)
+            pending[fut] = (i, s['submitted'], size, seeds)
+            s['submitted'] += 1
+
+        def fill_queue():
+            # Submit batches, in order of expected attempts needed, until the
+            # queue is full or the budget is exhausted.
+            while len(pending) < queue_size and submitted[0] < max_attempts:
+                if time_limit is not None and time.time() - t0 > time_limit:
+                    return
+                open_q = [i for i, s in enumerate(state) if needed(s) > 0]
+                if len(open_q) == 0:
+                    return
+                submit(min(open_q, key=lambda i: needed(state[i])))
+
+        #-------------------------------------------------------------------
+        # Main scheduling loop
+        #-------------------------------------------------------------------
+        pool = None
+        if workers != 0:
+            workers = workers or os.cpu_count() or 1
+            pool = ProcessPoolExecutor(max_workers=workers)
+            queue_size = 2 * workers
+        else:
+            queue_size = 1
+
+        t0 = time.time()
+        submitted = [0]
+        pending = {}
+
+        try:
+            fill_queue()
+            while len(pending) > 0:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    i, k, size, seeds = pending.pop(fut)
+                    s = state[i]
+                    result = fut.result()
+                    if type(result) is bytes:
+                        result = pickle.loads(result)
+                    elif result is None:
+                        # Versions whose variables hold lambdas, modules, etc. cannot be 
+                        # sent back from the workers. Those questions are generated in 
+                        # this process instead, starting with the failed batch. 
+                        if verbose and not s['local']:
+                            q = self.questions[i]
+                            print(f'{getattr(q, "id", f"question_{i+1}")}: versions cannot be sent between processes. '
+                                  'Generating in the current process.')
+                        s['local'] = True
+                        result = _attempt_versions(self.questions[i], seeds, report_errors)
+                    
+                    # Merge batches in the order they were submitted. 
+                    s['done'][k] = (size, result)
+                    while s['merged'] in s['done']:
+                        size, result = s['done'].pop(s['merged'])
+                        self.__merge_batch__(i, s, result, size, prevent_duplicates)
+                        s['merged'] += 1
+
+                # Stop waiting on remaining work once the time limit is reached
+                if time_limit is not None and time.time() - t0 > time_limit:
+                    for fut in pending:
+                        fut.cancel()
+                    break
+                fill_queue()
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        #-------------------------------------------------------------------
+        # Finalize versions and build summary
+        #-------------------------------------------------------------------
+        self.summary = []
+        for i, (q, s) in enumerate(zip(self.questions, state)):
+            q.__finalize_versions__()
+            self.summary.append({
+                'id': getattr(q, 'id', f'question_{i+1}'),
+                'requested': s['target'],
+                'versions': len(q.versions),
+                'attempts': q.num_attempts,
+                'acceptance': s['accepted'] / s['attempts'] if s['attempts'] > 0 else 0.0,
+                'duplicate': q.attempt_counts['duplicate'],
+                'condition': q.attempt_counts['condition'],
+                'error': q.attempt_counts['error'],
+                'surplus': q.attempt_counts['surplus'],
+                'complete': len(q.versions) >= s['target'],
+            })
+
+        self.elapsed = time.time() - t0
+        if verbose:
+            self.print_summary()
+
+
+    def __merge_batch__(self, i, s, result, size, prevent_duplicates):
+        '''
+        Adds the results of a completed batch to the question.
+        '''
+        q = self.questions[i]
+        versions, counts, error_log = result
+
+        s['in_flight'] -= size
+        s['attempts'] += size
+        q.num_attempts += size
+
+        for k in ['error', 'condition']:
+            q.attempt_counts[k] += counts[k]
+        for e, v in error_log.items():
+            if e not in q.error_log: q.error_log[e] = {'count':0, 'seeds':[]}
+            q.error_log[e]['count'] += v['count']
+            q.error_log[e]['seeds'].extend(v['seeds'])
+
+        for version in versions:
+            # Discard surplus versions once the target has been reached. They 
+            # still count towards the acceptance rate. 
+            if len(q.versions) >= s['target']:
+                q.attempt_counts['surplus'] += 1
+                s['accepted'] += 1
+                continue
+
+            # Versions from worker processes arrive without their question
+            version.question = q
+
+            if prevent_duplicates:
+                key = duplicate_key(version)
+                if key in s['seen']:
+                    q.attempt_counts['duplicate'] += 1
+                    continue
+                s['seen'].add(key)
+
+            q.versions.append(version)
+            q.attempt_counts['success'] += 1
+            s['accepted'] += 1
+
+
+    def generate_qti(self, path='', name='bank', pick=1, shuffle=True, seeds='hide', shuffle_seed=None, 
+                     workers=None, batch_size=200, pretty=True, cache_dir=None, compact=False, verbose=True):
+        '''
+        Writes the versions of all questions to a single QTI package, {name}_export.zip. 
+        The package contains one assessment with a section for each question. Each 
+        section draws pick versions of its question at random. 
+        
+        PARAMETERS
+        path       : directory for the package
+        name       : name of the package and assessment
+        pick       : number of versions drawn from each question. Either an int or a 
+                     list with one entry per question. 
+        shuffle    : shuffle the answer options
+        seeds      : 'hide' or 'show' the version seed in each item, or None to omit it
+        shuffle_seed : seed for the answer shuffles. If None, one is drawn from the global RNG. 
+        workers    : number of worker processes used to build item XML. None uses one 
+                     per CPU. 0 builds all items in the current process. 
+        batch_size : maximum number of versions sent to a worker at once
+        cache_dir  : directory for the QTI item cache. Items that have not changed since 
+                     the last export are reused. Defaults to the cache_dir of the bank, 
+                     then the APGEN_CACHE_DIR environment variable. 
+        compact    : write the XML without indentation or line breaks between tags. 
+                     Implies pretty=False. 
+        '''
+        from apgen.qti_convert import atomic_path, write_manifest, make_shuffles, zip_entry, item_cache_key, fill_seed, compact_xml
+        from apgen.cache import item_cache_path, load_items, save_items, template_key
+        from pathlib import Path
+        
+        picks = list(pick) if hasattr(pick, '__len__') else [pick] * len(self.questions)
+        zip_path = Path(path or '.') / f'{name}_export.zip'
+        out_file = f'{name}/{name}.xml'
+        
+        #-------------------------------------------------------------------
+        # Split each question's versions into batches. Item numbering runs 
+        # across the whole package so item identifiers are unique. 
+        #-------------------------------------------------------------------
+        if shuffle_seed is None:
+            shuffle_seed = int(np.random.randint(2**31))
+        
+        batches = []
+        offset = 0
+        for i, q in enumerate(self.questions):
+            perms, letters = make_shuffles([shuffle_seed, i], len(q.versions), len(q.answer_segments))
+            for start in range(0, len(q.versions), batch_size):
+                end = start + batch_size
+                batches.append((i, offset + start, q.versions[start:end], perms[start:end], letters[start:end]))
+            offset += len(q.versions)
+        
+        #-------------------------------------------------------------------
+        # Load the item cache of each question. Only items missing from the 
+        # cache are sent to the workers. Cached items hold a slot for the seed 
+        # span, which is filled in as items are written (see fill_seed). 
+        #-------------------------------------------------------------------
+        if cache_dir is None:
+            cache_dir = self.cache_dir
+        cache_paths = [item_cache_path(question_name(q), cache_dir) for q in self.questions]
+        caches = [None if p is None else load_items(p) for p in cache_paths]
+        qt_keys = [None if p is None else template_key(q.qt) for q, p in zip(self.questions, cache_paths)]
+        used = {p: {} for p in cache_paths if p is not None}
+        
+        pool = None
+        if workers != 0:
+            workers = workers or os.cpu_count() or 1
+            pool = ProcessPoolExecutor(max_workers=workers)
+            queue_size = 2 * workers
+        else:
+            queue_size = 1
+        
+        def submit(i, offset, versions, perms, letters):
+            q = self.questions[i]
+            numbers = list(range(offset, offset + len(versions)))
+            keys = None
+            if caches[i] is not None:
+                # Only build the items that are not cached. 
+                keys = [item_cache_key(qt_keys[i], n, v, shuffle, seeds, p, l, compact, q.css_classes) 
+                        for n, v, p, l in zip(numbers, versions, perms, letters)]
+                missing = [k for k in range(len(versions)) if keys[k] not in caches[i]]
+                numbers = [numbers[k] for k in missing]
+                versions = [versions[k] for k in missing]
+                perms = perms[missing]
+                letters = [letters[k] for k in missing]
+            fragments = keys is not None
+            
+            if pool is None or len(versions) == 0:
+                fut = Future()
+                fut.set_result(_qti_items(q, versions, numbers, shuffle, seeds, perms, letters, fragments, compact))
+            else:
+                # Only the fields and seed are sent. Workers render the text themselves. 
+                versions = [Version(status=v['status'], version_seed=v['version_seed'], fields=v['fields']) for v in versions]
+                fut = pool.submit(_run_qti_batch, q.qt, self.cache_dir, versions, numbers, shuffle, seeds, 
+                                  perms, letters, fragments, compact, q.css_classes)
+            return keys, fut
+        
+        def batch_items(i, versions, keys, fut):
+            items = fut.result()
+            if keys is None:
+                yield from items
+                return
+            
+            # Merge the new items with the cached ones. 
+            new_items = iter(items)
+            cache = caches[i]
+            kept = used[cache_paths[i]]
+            for key, version in zip(keys, versions):
+                fragment = cache.get(key)
+                if fragment is None:
+                    fragment = next(new_items)
+                kept[key] = fragment
+                yield fill_seed(fragment, seeds, version['version_seed'])
+        
+        # Headers and footers of the assessment and its sections. 
+        markup = (lambda text: text)
+        if compact:
+            markup = compact_xml
+            pretty = False
+        
+        #-------------------------------------------------------------------
+        # Write the package. Batches are submitted ahead of the writer, but 
+        # results are written in submission order so the output is stable. 
+        #-------------------------------------------------------------------
+        t0 = time.time()
+        try:
+            with atomic_path(zip_path) as tmp_path:
+                with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+                    with zf.open(zip_entry(out_file), 'w') as f:
+                        f.write(markup(self.__qti_header__(name)).encode('utf-8'))
+                        
+                        pending = deque()
+                        next_batch = 0
+                        current = None
+                        while next_batch < len(batches) or len(pending) > 0:
+                            while next_batch < len(batches) and len(pending) < queue_size:
+                                batch = batches[next_batch]
+                                pending.append((batch[0], batch[2], *submit(*batch)))
+                                next_batch += 1
+                            
+                            i, versions, keys, fut = pending.popleft()
+                            if i != current:
+                                if current is not None:
+                                    f.write(markup(self.__qti_section_footer__()).encode('utf-8'))
+                                f.write(markup(self.__qti_section_header__(i, picks[i])).encode('utf-8'))
+                                current = i
+                            for item in batch_items(i, versions, keys, fut):
+                                f.write((item + '\n').encode('utf-8'))
+                        
+                        if current is not None:
+                            f.write(markup(self.__qti_section_footer__()).encode('utf-8'))
+                        f.write(markup(self.__qti_footer__()).encode('utf-8'))
+                    
+                    with zf.open(zip_entry('imsmanifest.xml'), 'w') as f:
+                        write_manifest(f, [(name, 'imsqti_xmlv1p2', None, out_file)], pretty)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        
+        # Only the items used by this export are kept. 
+        for p, items in used.items():
+            save_items(p, items)
+        
+        if verbose:
+            num_v = sum(len(q.versions) for q in self.questions)
+            print(f'QTI file created successfully  -- {len(self.questions)} questions  -- {num_v} versions  '
+                  f'-- {time.time() - t0:.1f} seconds')
+    
+    
+    def __qti_header__(self, name):
+        return f'''<?xml version="1.0" encoding="UTF-8"?>
+<questestinterop xmlns="http://www.imsglobal.org/xsd/ims_qtiasiv1p2" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.imsglobal.org/xsd/ims_qtiasiv1p2 http://www.imsglobal.org/xsd/ims_qtiasiv1p2p1.xsd">
+              <assessment ident="assessID" title="{html.escape(name)}">
+                <qtimetadata>
+                  <qtimetadatafield>
+                    <fieldlabel>cc_maxattempts</fieldlabel>
+                    <fieldentry>1</fieldentry>
+                  </qtimetadatafield>
+                </qtimetadata>
+                <section ident="root_section">
+'''
+    
+    
+    def __qti_section_header__(self, i, pick):
+        # Canvas imports a section with a selection as a question group. 
+        title = getattr(self.questions[i], 'id', f'question_{i+1}')
+        return f'''
+                  <section ident="group_{i+1}" title="{html.escape(title)}">
+                    <selection_ordering>
+                      <selection>
+                        <selection_number>{pick}</selection_number>
+                        <selection_extension>
+                          <points_per_item>1</points_per_item>
+                        </selection_extension>
+                      </selection>
+                    </selection_ordering>
+'''
+    
+    
+    def __qti_section_footer__(self):
+        return '''
+                  </section>
+'''
+    
+    
+    def __qti_footer__(self):
+        return '''
+                </section>
+              </assessment>
+            </questestinterop>
+'''
+    
+    
+    def print_summary(self):
+        '''
+        Prints one table summarizing version generation for all questions.
+        '''
+        print(f'{"id":<24}  {"versions":>9}  {"attempts":>9}  {"accept":>7}  {"dup":>6}  {"cond":>6}  {"error":>6}  {"surplus":>7}')
+        print('-' * 89)
+        for r in self.summary:
+            flag = '' if r['complete'] else '  INCOMPLETE'
+            print(f'{r["id"]:<24}  {r["versions"]:>4}/{r["requested"]:<4}  {r["attempts"]:>9}  '
+                  f'{r["acceptance"]:>7.1%}  {r["duplicate"]:>6}  {r["condition"]:>6}  {r["error"]:>6}  {r["surplus"]:>7}{flag}')
+        print('-' * 89)
+        total_v = sum(r['versions'] for r in self.summary)
+        total_a = sum(r['attempts'] for r in self.summary)
+        print(f'{len(self.summary)} questions  -- {total_a} attempts  -- {total_v} versions  -- {self.elapsed:.1f} seconds')
@@ -0,0 +1,181 @@
+import hashlib
+import importlib.util
+import marshal
+import os
+
+#----------------------------------------------------------------------
+# On-disk cache of compiled question templates.
+#
+# A compiled template is the state a Question has after parsing:
+# config values, text sections, processed text and the code objects
+# used during version generation. It is stored as a single marshal
+# blob, so loading it is one read + marshal.loads().
+#----------------------------------------------------------------------
+
+CACHE_EXT = '.apc'
+
+# Increase this whenever the attributes stored for a compiled template change. 
+CACHE_FORMAT = 5
+
+
+def normalize_template(qt):
+    '''
+    Normalizes a question template so that templates which parse
+    identically also hash identically.
+    '''
+    qt = qt.replace('\r\n', '\n').replace('\r', '\n')
+    return qt.strip()
+
+
+def template_key(qt):
+    '''
+    Returns the cache key for a template. The key depends on the normalized
+    template, the apgen version, the cache format, and the Python bytecode 
+    version (since marshalled code objects are not portable across Python versions).
+    '''
+    from apgen import __version__
+
+    h = hashlib.sha256()
+    h.update(__version__.encode())
+    h.update(str(CACHE_FORMAT).encode())
+    h.update(importlib.util.MAGIC_NUMBER)
+    h.update(normalize_template(qt).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_cache_dir(cache_dir=None):
+    '''
+    Returns the cache directory to use. If no directory is provided, the
+    APGEN_CACHE_DIR environment variable is used. Returns None if caching
+    is disabled.
+    '''
+    if cache_dir is None:
+        cache_dir = os.environ.get('APGEN_CACHE_DIR')
+    return cache_dir
+
+
+def load_compiled(qt, cache_dir=None):
+    '''
+    Loads the compiled form of a template from the cache.
+    Returns None if caching is disabled or if the template is not cached.
+    '''
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return None
+
+    path = os.path.join(cache_dir, template_key(qt) + CACHE_EXT)
+    try:
+        with open(path, 'rb') as f:
+            data = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        # Missing or unreadable entries are treated as cache misses.
+        return None
+
+    # Entries are stored with the format they were written in. Entries written
+    # in any other format (including ones with no format) are cache misses, 
+    # even if their key happens to match. 
+    if type(data) is not tuple or len(data) != 2 or data[0] != CACHE_FORMAT or type(data[1]) is not dict:
+        return None
+    return data[1]
+
+
+def save_compiled(qt, compiled, cache_dir=None):
+    '''
+    Stores the compiled form of a template in the cache. The file is written
+    to a temporary name and renamed into place so that concurrent workers
+    never see a partially written entry.
+    '''
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, template_key(qt) + CACHE_EXT)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(marshal.dumps((CACHE_FORMAT, compiled)))
+    os.replace(tmp_path, path)
+
+
+def clear_cache(cache_dir=None):
+    '''
+    Deletes all compiled templates and cached QTI items from the cache directory.
+    '''
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return
+
+    for fname in os.listdir(cache_dir):
+        if fname.endswith(CACHE_EXT):
+            os.remove(os.path.join(cache_dir, fname))
+
+    item_dir = os.path.join(cache_dir, ITEM_DIR)
+    if os.path.isdir(item_dir):
+        for fname in os.listdir(item_dir):
+            if fname.endswith(ITEM_EXT):
+                os.remove(os.path.join(item_dir, fname))
+
+
+#----------------------------------------------------------------------
+# On-disk cache of QTI item fragments.
+#
+# Each question has one file in the qti subdirectory of the cache dir
+# holding a marshalled dict {key: item xml}. Keys are hashes of
+# everything that goes into an item (see item_key), so a fragment is
+# only reused if the item would come out the same. The file is
+# rewritten after each export with only the items that export used.
+#----------------------------------------------------------------------
+
+ITEM_DIR = 'qti'
+ITEM_EXT = '.apq'
+
+
+def item_key(*parts):
+    '''
+    Returns the cache key for a QTI item built from the given parts. Parts
+    must be values marshal can dump (str, int, float, None, lists, tuples).
+    '''
+    from apgen import __version__
+
+    data = marshal.dumps((__version__, CACHE_FORMAT) + parts)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def item_cache_path(name, cache_dir=None):
+    '''
+    Returns the path of the item cache file for a question, or None if
+    caching is disabled.
+    '''
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, ITEM_DIR, name + ITEM_EXT)
+
+
+def load_items(path):
+    '''
+    Loads the cached item fragments stored at path. Returns an empty dict
+    if the file is missing or unreadable.
+    '''
+    if path is None:
+        return {}
+    try:
+        with open(path, 'rb') as f:
+            items = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    return items if isinstance(items, dict) else {}
+
+
+def save_items(path, items):
+    '''
+    Stores item fragments at path, replacing the previous file.
+    '''
+    if path is None:
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(marshal.dumps(items))
+    os.replace(tmp_path, path)
@@ -1,20 +1,29 @@
+import ast
+import re
+import functools
+import hashlib
 import numpy as np
+from collections import OrderedDict
 from apgen.functions import *
+from apgen.cache import normalize_template, load_compiled, save_compiled
 
 class Question:
 
-    def __init__(self, qt=None, file=None):
+    def __init__(self, qt=None, file=None, cache_dir=None):
         '''
         Class representing a single question. 
         
         PARAMETERS
-        file : path for file containing question template
-        qt   : string containing question template
+        file      : path for file containing question template
+        qt        : string containing question template
+        cache_dir : directory for caching compiled templates and QTI items. If None, 
+                    the APGEN_CACHE_DIR environment variable is used, if set. 
         '''
         
         # Create some basic attributes
         self.file = file             
         self.qt = qt
+        self.cache_dir = cache_dir
         self.type = 'MC'
         self.margin = '0'
         self.error_log={}
@@ -33,6 +42,19 @@ class Question:
         self.versions = []
         self.max_versions = float('inf')
         
+        # Version text is rendered when first accessed. Rendered text is cached 
+        # for at most text_cache_size versions (None = no limit, 0 = no caching). 
+        self.text_cache_size = None
+        self.text_cache = OrderedDict()
+        self.qti_options = {'shuffle': True, 'seeds': 'hide', 'shuffle_seed': 0, 'compact': False}
+        self.qti_shuffles = None     # Answer shuffles used for qti_text, see __render_version__
+        self.qti_convertor = None    # makeQTI used for qti_text, see __render_version__
+        
+        # If css_classes is True, inline styles in the text are replaced by classes 
+        # and a stylesheet is output with the text. See use_css_classes. 
+        self.css_classes = False
+        self.css_state = None
+        
         # Check if a template has been provided. 
         if qt is None and file is None:
             print('No problem template has been provided.')
@@ -46,11 +68,20 @@ class Question:
             if id is None:
                 filename = file.split('/')[-1]
                 self.id = filename.split('.')[0]
-        self.qt = self.qt.strip()
+        self.qt = normalize_template(self.qt)
+
+        # Load the compiled template from the cache, if available. 
+        compiled = load_compiled(self.qt, cache_dir)
+        if compiled is not None:
+            self.__dict__.update(compiled)
+            return
 
         # Parse the template and text
         self.__parse_template__()
         self.__parse_text__()
+        self.__compile_code__()
+        
+        save_compiled(self.qt, self.__compiled_state__(), cache_dir)
         
 
     def __parse_template__(self):
@@ -190,6 +221,43 @@ class Question:
         
         self.text = text
         
+        # Split the text and answer options into literal text and placeholders. 
+        # Placeholders that appear more than once are only evaluated once per version. 
+        segment_lists = [compile_text(self.text, self.var_delim)]
+        segment_lists += [compile_text(ao, self.var_delim) for ao in self.answer_options]
+        self.placeholders, self.fields, segment_lists = share_placeholders(segment_lists)
+        self.text_segments = segment_lists[0]
+        self.text_fields = [s for s in self.text_segments if isinstance(s, int)]
+        self.answer_segments = segment_lists[1:]
+        
+        # Equations without placeholders are converted for QTI export here, once. 
+        from apgen.qti_convert import hoist_equations
+        self.qti_text_segments = hoist_equations(self.text_segments)
+        self.qti_answer_segments = [hoist_equations(ao) for ao in self.answer_segments]
+        
+    
+    def __compile_code__(self):
+        '''
+        Compiles the variable script and conditions once so that they do not 
+        need to be recompiled for every attempt during version generation. 
+        '''
+        self.var_code = compile_source(self.var_script, '<variables>', 'exec')
+        self.cond_code = [compile_source(c, '<condition>', 'eval') for c in self.conditions]
+    
+    
+    def __compiled_state__(self):
+        '''
+        Returns the attributes created while parsing and compiling the template. 
+        These are stored in the template cache. 
+        '''
+        keys = ['type', 'margin', 'max_versions', 'var_script', 'conditions', 'text_raw', 'text', 
+                'answer_options', 'text_sections', 'text_segments', 'text_fields', 'answer_segments', 
+                'qti_text_segments', 'qti_answer_segments', 'placeholders', 'fields', 
+                'var_code', 'cond_code']
+        if hasattr(self, 'id'):
+            keys.append('id')
+        return {k:getattr(self, k) for k in keys}
+        
         
     def __process_section__(self, s):
         text = ''
@@ -241,7 +309,7 @@ class Question:
             table_config = {}
             
             for line in s['lines'][1:-2]:
-                cells = line.split('|')[1:-1]
+                cells = split_table_row(line, self.var_delim)[1:-1]
                 cells = [c.strip(' ') for c in cells]
                 table_contents.append(cells)
             params = s['lines'][-2].split(';')
@@ -250,7 +318,7 @@ class Question:
                 p = p.strip(' ')
                 v = v.strip(' ')
                 if v not in ['C', 'L', 'R']:
-                    v = eval(v)
+                    v = table_config_value(v)
                 table_config[p.lower()] = v
             
             text += TABLE(contents=table_contents, config=table_config, inc_margin=False)
@@ -280,9 +348,9 @@ class Question:
         from IPython.core.display import HTML, display
         from tqdm.notebook import tqdm
         import time
-        import re
         
         self.versions = []
+        self.text_cache = OrderedDict()
         
         self.num_attempts = 0
         
@@ -310,6 +378,11 @@ class Question:
         t0 = time.time()
         limit_reached = False
         
+        #-------------------------------------------------------------------
+        # Duplicate keys of versions generated so far
+        #-------------------------------------------------------------------
+        seen = set()
+        
         #-------------------------------------------------------------------
         # Loop for the desired number of versions
         #-------------------------------------------------------------------
@@ -384,20 +457,12 @@ class Question:
                 if prevent_duplicates:
                     
                     # Names need to be stripped out since they mess up the duplicate checking process
-                    text_no_names = re.sub(r'__NAMEa__.*?__NAMEb__', '', version['text'])
-                    
-                    dup = False
-                    for v in self.versions:
-                        other_text = re.sub(r'__NAMEa__.*?__NAMEb__', '', v['text'])
-                        
-                        if text_no_names == other_text:
-                        #if version['text'] == v['text']:
-                            self.attempt_counts['duplicate'] += 1
-                            dup = True 
-                            break
-                    if dup: 
+                    key = duplicate_key(version)
+                    if key in seen:
+                        self.attempt_counts['duplicate'] += 1
                         version = None
                         continue
+                    seen.add(key)
                 
                 break  # if here, a version was found
             
@@ -427,11 +492,7 @@ class Question:
         #-------------------------------------------------------------
         # Time to remove name delimiters
         #-------------------------------------------------------------
-        for i, v in enumerate(self.versions):
-            self.versions[i]['text'] = self.versions[i]['text'].replace('__NAMEa__', '')
-            self.versions[i]['text'] = self.versions[i]['text'].replace('__NAMEb__', '')
-            self.versions[i]['colab_text'] = self.versions[i]['text'].replace('__NAMEa__', '')
-            self.versions[i]['colab_text'] = self.versions[i]['text'].replace('__NAMEb__', '')
+        self.__finalize_versions__()
         
         #-------------------------------------------------------------
         # Output results 
@@ -461,6 +522,116 @@ class Question:
                     print(v['seeds'])
         
         return 
+    
+    
+    def __finalize_versions__(self):
+        '''
+        Removes the name delimiters from the fields of the generated versions. 
+        '''
+        self.text_cache = OrderedDict()
+        for n, v in enumerate(self.versions):
+            v.question = self
+            v.index = n
+            v.clear_text()
+            v['fields'] = tuple(f.replace('__NAMEa__', '').replace('__NAMEb__', '') for f in v['fields'])
+    
+    
+    def __render_version__(self, v, key):
+        '''
+        Returns text for a version, rendering it from the stored fields if it 
+        has not been cached. Used by Version for the keys in Version.LAZY_KEYS. 
+        '''
+        if dict.__contains__(v, key):
+            self.__touch_version__(v)
+            return dict.__getitem__(v, key)
+        
+        if v['fields'] is None:
+            return None
+        
+        if key == 'text':
+            value = join_segments(self.__segments__('text_segments'), v['fields'])
+        elif key == 'answer_options':
+            value = [join_segments(ao, v['fields']) for ao in self.answer_segments]
+        elif key == 'colab_text':
+            value = katex_delimiters(v['text'])
+        elif key == 'colab_answer_options':
+            value = [katex_delimiters(str(ao)) for ao in v['answer_options']]
+        elif key == 'qti_text':
+            from apgen.qti_convert import makeQTI, make_shuffles
+            n = v.index
+            if n is None or n >= len(self.versions) or self.versions[n] is not v:
+                n = next(i for i, x in enumerate(self.versions) if x is v)
+            
+            # The shuffles for all versions are drawn once per shuffle seed. 
+            opts = self.qti_options
+            shuffle_key = (opts['shuffle_seed'], len(self.versions), len(self.answer_segments))
+            if self.qti_shuffles is None or self.qti_shuffles[0] != shuffle_key:
+                self.qti_shuffles = (shuffle_key, *make_shuffles(*shuffle_key))
+            _, perms, letters = self.qti_shuffles
+            
+            # One convertor is used for all versions with the same options. 
+            convertor_key = (opts['shuffle'], opts['shuffle_seed'], opts['compact'], self.css_classes)
+            if self.qti_convertor is None or self.qti_convertor[0] != convertor_key:
+                convertor = makeQTI(self, path='', shuffle=opts['shuffle'], shuffle_seed=opts['shuffle_seed'], 
+                                    compact=opts['compact'])
+                self.qti_convertor = (convertor_key, convertor)
+            convertor = self.qti_convertor[1]
+            value = convertor.build_item(n, v, opts['seeds'], perms[n], letters[n])
+        
+        self.__cache_version_text__(v, key, value)
+        return value
+    
+    
+    def use_css_classes(self, on=True):
+        '''
+        If on, the inline styles in the question text are replaced by short class 
+        names and the styles are output once, as a stylesheet. This is done once 
+        per display and once per item in QTI files. 
+        '''
+        self.css_classes = on
+        for v in self.versions:
+            v.clear_text()
+    
+    
+    def __css__(self):
+        '''
+        Returns the text segments with classes in place of inline styles, along 
+        with the stylesheet for those classes. Created once per question. 
+        '''
+        if self.css_state is None:
+            styles = {}
+            self.css_state = {
+                'text_segments': [css_classes(s, styles) if type(s) is str else s for s in self.text_segments], 
+                'qti_text_segments': [css_classes(s, styles) if type(s) is str else s for s in self.qti_text_segments], 
+            }
+            self.css_state['stylesheet'] = stylesheet(styles)
+        return self.css_state
+    
+    
+    def __segments__(self, name):
+        # Returns text_segments or qti_text_segments, with classes if enabled. 
+        if self.css_classes:
+            return self.__css__()[name]
+        return getattr(self, name)
+    
+    
+    def __cache_version_text__(self, v, key, value):
+        if self.text_cache_size == 0:
+            return
+        dict.__setitem__(v, key, value)
+        self.__touch_version__(v)
+    
+    
+    def __touch_version__(self, v):
+        # Move the version to the end of the LRU order, dropping the rendered 
+        # text of the least recently used versions if the limit is exceeded. 
+        if self.text_cache_size is None:
+            return
+        self.text_cache[id(v)] = v
+        self.text_cache.move_to_end(id(v))
+        while len(self.text_cache) > self.text_cache_size:
+            _, old = self.text_cache.popitem(last=False)
+            old.clear_text()
         
 
     def generate_one(self, seed, report_errors=True):
@@ -485,22 +656,18 @@ class Question:
         #-------------------------------------------------------------
         # Create Dictionary for storing information about the version
         #-------------------------------------------------------------
-        version_dict = {
-            'status': 'Success',
-            'version_seed': seed,
-            'text' : None,
-            'colab_text': None,
-            #'jupyter_text': None,
-            'qti_text': None,
-            'answer_options' : None,
-            'var_defns' : scope
-        }
+        version_dict = Version(self, 
+            status = 'Success',
+            version_seed = seed,
+            fields = None,
+            var_defns = scope
+        )
         
         #-------------------------------------------------------------
         # Execute Variables
         #-------------------------------------------------------------
         try:
-            exec(self.var_script, scope)
+            exec(self.var_code, scope)
         
         except Exception as e:
             # Error encountered
@@ -524,7 +691,7 @@ class Question:
         #-------------------------------------------------------------
         # Check conditions, return if invalid
         #-------------------------------------------------------------
-        for cond in self.conditions:
+        for cond in self.cond_code:
             try:
                 valid = eval(cond, scope)
             except Exception as e:
@@ -547,8 +714,7 @@ class Question:
         # Determine Answer Values
         #-------------------------------------------------------------
         try:
-            text_w_vars = insert_vars(self.text, scope)
-            ans_w_vars = [insert_vars(ao, scope) for ao in self.answer_options]
+            fields = render_fields(self.placeholders, self.fields, scope)
         except Exception as e:
             self.attempt_counts['error'] += 1
             e = repr(e)
@@ -567,17 +733,18 @@ class Question:
             del scope[k]
         
         #-------------------------------------------------------------
-        # Add the text and answer values to the version dict
+        # Add the formatted fields to the version dict. The text and 
+        # answer options are rendered from these when needed. 
         #-------------------------------------------------------------
-        version_dict['text'] = text_w_vars
-        version_dict['answer_options'] = ans_w_vars
+        version_dict['fields'] = tuple(fields)
         
         return version_dict
 
 
-    def create_display_html(self, size=3, limit=None, compact_answers=False, show_seeds=False):
+    def create_display_html(self, size=3, limit=None, compact_answers=False, show_seeds=False, start=0):
         #-------------------------------------------------------------
         # Creates HTML for displaying question version. 
+        # Only the versions from start to start+limit are rendered. 
         #-------------------------------------------------------------
         
         from IPython.display import HTML, display, Markdown, Latex, Javascript
@@ -600,96 +767,20 @@ class Question:
         # Determine number of questions to display 
         #-------------------------------------------------------------
         if limit is None: limit = len(self.versions) 
-        limit = min(limit, len(self.versions))
+        limit = min(limit, len(self.versions) - start)
         
         #-------------------------------------------------------------
         # Add "Displaying Versions" Header
         #-------------------------------------------------------------
         out = '<b><font size=5>Displaying Versions</font></b>'
+        if self.css_classes:
+            out += self.__css__()['stylesheet']
 
         #-------------------------------------------------------------
         # Add Versions to the output
         #-------------------------------------------------------------
-        for i in range(limit):
-            # Obtain version text. This is used when not in Colab
-            question_text = self.versions[i]['text']
-                        
-            # Mess around with Dollar Signs to be able to use Katex in Colab. 
-            colab_text = question_text.replace(r'\$', '__DOLLAR__SIGN__')   # Replace escaped dollar signs. 
-            colab_text = colab_text.replace(r'$$', '__DEQN__')           # Replace $$ with __$$__ to be used with Katex
-            colab_text = colab_text.replace(r'$', '__EQN__')             # Replace $ with __$__ to be used with Katex
-            colab_text = colab_text.replace('__DOLLAR__SIGN__', r'$')    # Put escaped dollar signs back in as $. 
-            
-            #-------------------------------------------------
-            # Display the version text (without answers)
-            #-------------------------------------------------
-            seed_text = f'  <font size=2>({self.versions[i]["version_seed"]})</font>' if show_seeds else ''
-            
-            # Add Version Number and Seed
-            out += f'<br/><br/><hr><p>'
-            out += f'<b><font size=4>Version {i+1}</font></b>{seed_text}<br/>'
-            
-            # Add Either Colab or Standard text, as needed
-            if COLAB:   
-                out += f'<font size="{size}">{colab_text}</font></p>'
-            else:
-                out += f'<font size="{size}">{question_text}</font></p>'
-            self.versions[i]['colab_text'] = colab_text
-            
-            #-----------------------------------------------
-            # Display the Answers
-            #-----------------------------------------------
-            out += f'<p><b><font size={size}>Answer Options</font></b></p>'
-            
-            answer_options = self.versions[i]['answer_options'].copy()
-            if COLAB:
-                for i, ao in enumerate(answer_options):
-                    ao = str(ao)
-                    ao = ao.replace(r'\$', '__DOLLAR__SIGN__')   # Replace escaped dollar signs. 
-                    ao = ao.replace(r'$$', '__DEQN__')           # Replace $$ with __$$__ to be used with Katex
-                    ao = ao.replace(r'$', '__EQN__')             # Replace $ with __$__ to be used with Katex
-                    ao = ao.replace('__DOLLAR__SIGN__', r'$')    # Put escaped dollar signs back in as $. 
-                    answer_options[i] = ao
-            
-            # Multiple Choice
-            if self.type == 'MC':
-                
-                letters = list('abcdefghijklmnopqrstuvwzyz')
-                ans_str = ''
-                for i, ao in enumerate(answer_options):
-                    x = letters[i]
-                    ans_str += f'<tt>[{x}]</tt> {ao}' if i==0 else f'<tt>({x})</tt> {ao}'
-                    ans_str += '&nbsp'*12 if compact_answers else '<br/>\n'
-                ans_str = ans_str.strip('\n')
-                out += ans_str
-                        
-            # Multiple Answer
-            elif self.type == 'MA':
-                ans_str = ''
-                for i, ao in enumerate(answer_options):
-                    #print(f'[{x}] {ao}' if i==0 else f'({x}) {ao}')
-                    ao_mod = ao
-                    if ao_mod[:3] == '[ ]': ao_mod = '<tt>[ ]</tt>' + ao_mod[3:]
-                    elif ao_mod[:3] == '[X]': ao_mod = '<tt>[X]</tt>' + ao_mod[3:]
-                    
-                    ans_str += f'{ao_mod}'
-                    ans_str += '&nbsp'*12 if compact_answers else '<br/>\n'
-                ans_str = ans_str.strip('\n')
-                out += ans_str
-                
-            # Numerical
-            elif self.type == 'NUM':
-                out += f'ANSWER: {answer_options[0]}'
-            
-            # Matching
-            elif self.type == 'MT':
-                ans_str = ''
-                for i, ao in enumerate(answer_options):
-                    ans_str += ao
-                    ans_str += '&nbsp'*12 if compact_answers else '<br/>\n'
-                out += ans_str
-                #for ao in answer_options:
-                #    out += f'{ao}'    
+        for i in range(start, start + limit):
+            out += self.__version_html__(i, size, compact_answers, show_seeds, COLAB)
         
         #-------------------------------------------------------------
         # Close out the HTML for the current version
@@ -698,10 +789,103 @@ class Question:
         
         return out
     
-    def display_versions(self, size=3, limit=None, compact_answers=False, show_seeds=False):    
+    def __version_html__(self, i, size=3, compact_answers=False, show_seeds=False, COLAB=False):
+        #-------------------------------------------------------------
+        # Creates the HTML for a single version. 
+        #-------------------------------------------------------------
+        
+        # Obtain version text. This is used when not in Colab
+        question_text = self.versions[i]['text']
+                    
+        # Dollar signs are replaced to be able to use Katex in Colab. 
+        colab_text = self.versions[i]['colab_text'] if COLAB else None
+        
+        #-------------------------------------------------
+        # Display the version text (without answers)
+        #-------------------------------------------------
+        seed_text = f'  <font size=2>({self.versions[i]["version_seed"]})</font>' if show_seeds else ''
+        
+        # Add Version Number and Seed
+        out = f'<br/><br/><hr><p>'
+        out += f'<b><font size=4>Version {i+1}</font></b>{seed_text}<br/>'
+        
+        # Add Either Colab or Standard text, as needed
+        if COLAB:   
+            out += f'<font size="{size}">{colab_text}</font></p>'
+        else:
+            out += f'<font size="{size}">{question_text}</font></p>'
+        
+        #-----------------------------------------------
+        # Display the Answers
+        #-----------------------------------------------
+        out += f'<p><b><font size={size}>Answer Options</font></b></p>'
+        
+        # Dollar signs are replaced in the answers as well. 
+        answer_options = self.versions[i]['colab_answer_options' if COLAB else 'answer_options']
+        
+        # Multiple Choice
+        if self.type == 'MC':
+            
+            letters = list('abcdefghijklmnopqrstuvwzyz')
+            ans_str = ''
+            for i, ao in enumerate(answer_options):
+                x = letters[i]
+                ans_str += f'<tt>[{x}]</tt> {ao}' if i==0 else f'<tt>({x})</tt> {ao}'
+                ans_str += '&nbsp'*12 if compact_answers else '<br/>\n'
+            ans_str = ans_str.strip('\n')
+            out += ans_str
+                    
+        # Multiple Answer
+        elif self.type == 'MA':
+            ans_str = ''
+            for i, ao in enumerate(answer_options):
+                #print(f'[{x}] {ao}' if i==0 else f'({x}) {ao}')
+                ao_mod = ao
+                if ao_mod[:3] == '[ ]': ao_mod = '<tt>[ ]</tt>' + ao_mod[3:]
+                elif ao_mod[:3] == '[X]': ao_mod = '<tt>[X]</tt>' + ao_mod[3:]
+                
+                ans_str += f'{ao_mod}'
+                ans_str += '&nbsp'*12 if compact_answers else '<br/>\n'
+            ans_str = ans_str.strip('\n')
+            out += ans_str
+            
+        # Numerical
+        elif self.type == 'NUM':
+            out += f'ANSWER: {answer_options[0]}'
+        
+        # Matching
+        elif self.type == 'MT':
+            ans_str = ''
+            for i, ao in enumerate(answer_options):
+                ans_str += ao
+                ans_str += '&nbsp'*12 if compact_answers else '<br/>\n'
+            out += ans_str
+            #for ao in answer_options:
+            #    out += f'{ao}'
+        
+        return out
+
+    def display_versions(self, size=3, limit=None, compact_answers=False, show_seeds=False, start=0, page_size=None):    
+        '''
+        Displays the versions of the question. 
+        
+        PARAMETERS
+        size            : font size
+        limit           : maximum number of versions to display
+        compact_answers : display the answer options on one line
+        show_seeds      : display the seed of each version
+        start           : index of the first version to display
+        page_size       : if set, versions are displayed page_size at a time, with buttons for 
+                          the next and previous pages and a box to jump to a version seed. 
+                          Only the current page is rendered. Requires ipywidgets. 
+        '''
         from IPython.display import HTML, display, Markdown, Latex, Javascript
         import sys
         
+        if page_size is not None:
+            self.__display_pages__(page_size, size, compact_answers, show_seeds, start)
+            return
+        
         #-------------------------------------------------------------
         # Check if Colab. If so, we need a hack to render LaTex
         #-------------------------------------------------------------
@@ -713,7 +897,7 @@ class Question:
         # Generate HTML output
         #-------------------------------------------------------------
         out = self.create_display_html(
-            size=size, limit=limit, compact_answers=compact_answers, show_seeds=show_seeds
+            size=size, limit=limit, compact_answers=compact_answers, show_seeds=show_seeds, start=start
         )
         display(HTML(out))
         
@@ -723,9 +907,130 @@ class Question:
         if COLAB: 
             from apgen.autorender import katex_autorender_min
             display(Javascript(katex_autorender_min))
+    
+    
+    def __display_pages__(self, page_size, size=3, compact_answers=False, show_seeds=False, start=0):
+        '''
+        Displays the versions one page at a time. Each page is rendered when it 
+        is shown, so the cost depends on the page size rather than the number 
+        of versions. 
+        '''
+        from IPython.display import display
+        
+        try:
+            import ipywidgets as widgets
+        except ImportError:
+            print('ipywidgets is not installed, so only one page is displayed. '
+                  'Use the start parameter to display other pages.')
+            self.display_versions(size, page_size, compact_answers, show_seeds, start=start)
+            return
+        
+        n = len(self.versions)
+        current = {'start': start}
+        seeds = {}
+        
+        prev_button = widgets.Button(description='Previous')
+        next_button = widgets.Button(description='Next')
+        seed_box = widgets.IntText(description='Seed')
+        seed_button = widgets.Button(description='Go')
+        label = widgets.Label()
+        out = widgets.Output()
+        
+        def show(k):
+            if k >= n: 
+                return
+            k = max(k, 0)
+            current['start'] = k
+            label.value = f'Versions {k+1} to {min(k+page_size, n)} of {n}'
+            out.clear_output(wait=True)
+            with out:
+                self.display_versions(size, page_size, compact_answers, show_seeds, start=k)
+        
+        def jump(b):
+            # Seeds are indexed the first time they are needed. 
+            if len(seeds) == 0:
+                seeds.update({v['version_seed']:i for i, v in enumerate(self.versions)})
+            k = seeds.get(seed_box.value)
+            if k is None:
+                label.value = f'No version has seed {seed_box.value}'
+            else:
+                show(k)
+        
+        prev_button.on_click(lambda b: show(current['start'] - page_size))
+        next_button.on_click(lambda b: show(current['start'] + page_size))
+        seed_button.on_click(jump)
+        
+        controls = widgets.HBox([prev_button, next_button, label, seed_box, seed_button])
+        display(widgets.VBox([controls, out]))
+        show(start)
 
 
 
+    def export_html(self, path=None, size=3, compact_answers=False, show_seeds=False, versions_per_file=None):
+        '''
+        Writes the versions of the question to a standalone HTML file that can be 
+        opened in any browser. Equations are rendered with KaTeX, which is included 
+        once per file. Versions are written one at a time, so the full page is never 
+        held in memory. 
+        
+        PARAMETERS
+        path              : name of the file. Defaults to {id}.html, or {template key}.html 
+                            if the template does not set an id
+        size              : font size
+        compact_answers   : display the answer options on one line
+        show_seeds        : display the seed of each version
+        versions_per_file : if set, the versions are split across several files, 
+                            {name}_01.html, {name}_02.html, ..., each holding at most 
+                            this many versions. 
+        
+        Returns the list of files written. 
+        '''
+        from apgen.autorender import katex_autorender_min
+        import os
+        
+        name = question_name(self)
+        if path is None:
+            path = f'{name}.html'
+        
+        n = len(self.versions)
+        if versions_per_file is None or versions_per_file >= n:
+            parts = [(path, 0, n)]
+        else:
+            root, ext = os.path.splitext(path)
+            parts = [
+                (f'{root}_{k+1:02}{ext or ".html"}', a, min(a + versions_per_file, n))
+                for k, a in enumerate(range(0, n, versions_per_file))
+            ]
+        
+        #-------------------------------------------------------------
+        # The text uses the Colab delimiters, which is what the 
+        # auto-render script in autorender.py looks for. 
+        #-------------------------------------------------------------
+        for fname, a, b in parts:
+            with open(fname, 'w', encoding='utf-8') as f:
+                f.write(f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{name}</title>\n')
+                f.write(KATEX_INCLUDE)
+                f.write('</head>\n<body>\n')
+                
+                f.write(f'<b><font size=5>{name}</font></b>')
+                if len(parts) > 1:
+                    f.write(f'<br/><font size=3>Versions {a+1} to {b} of {n}</font>')
+                if self.css_classes:
+                    f.write(self.__css__()['stylesheet'])
+                if n == 0:
+                    f.write('<p>No versions have been generated.</p>')
+                
+                for i in range(a, b):
+                    f.write(self.__version_html__(i, size, compact_answers, show_seeds, COLAB=True))
+                    f.write('\n')
+                
+                f.write('<br/><br/><hr>\n')
+                f.write(f'<script>\n{katex_autorender_min}\n</script>\n</body>\n</html>\n')
+        
+        print(f'{n} versions written to {len(parts)} file{"s" if len(parts) > 1 else ""}.')
+        return [fname for fname, a, b in parts]
+    
+    
     def display_versions_OLD(self, size=3, limit=None, compact_answers=False, show_seeds=False):
         #-------------------------------------------------------------
         # This was deprecated in early 2025. Should be deleted eventually. 
@@ -841,17 +1146,63 @@ class Question:
             from apgen.autorender import katex_autorender_min
             display(Javascript(katex_autorender_min))
     
+    def version_table(self):
+        '''
+        Returns the variable values of all versions as a columnar table: 
+        a dict mapping each variable name to a list with one value per version. 
+        '''
+        if len(self.versions) == 0:
+            return {}
+        names = list(self.versions[0]['var_defns'])
+        return {k:[v['var_defns'][k] for v in self.versions] for k in names}
+    
+    def render_columns(self, columns, n=None):
+        '''
+        Renders the text and answer options for many versions at once from a 
+        columnar table of variable values (see version_table). 
+        
+        Returns a list of texts and a list of answer option lists. 
+        '''
+        if n is None:
+            n = len(columns[list(columns)[0]])
+        
+        field_columns = render_field_columns(self.placeholders, self.fields, columns, n)
+        texts = assemble_columns(self.__segments__('text_segments'), field_columns, n)
+        answers = [assemble_columns(ao, field_columns, n) for ao in self.answer_segments]
+        
+        # Remove name delimiters
+        texts = [t.replace('__NAMEa__', '').replace('__NAMEb__', '') for t in texts]
+        answers = [list(row) for row in zip(*answers)] if len(answers) > 0 else [[] for i in range(n)]
+        return texts, answers
+    
     def version_details(self, i, show_colab_text=False, show_qti_text=False):
         v = self.versions[i]
         version_details(v, show_colab_text, show_qti_text)
            
-    def generate_qti(self, path='', overwrite=True, shuffle=True, save_template=False, seeds='hide', create_files=True, verbose=True):
+    def generate_qti(self, path='', overwrite=True, shuffle=True, save_template=False, seeds='hide', create_files=True, 
+                     shuffle_seed=None, cache_dir=None, compact=False, verbose=True):
+        '''
+        Writes the versions of the question to a QTI package, {id}_export.zip. 
+        
+        PARAMETERS
+        path          : directory for the package
+        overwrite     : if False, a version number is added to the id instead of replacing an existing package
+        shuffle       : shuffle the answer options
+        save_template : also save the template to path
+        seeds         : 'hide' or 'show' the version seed in each item, or None to omit it
+        create_files  : if False, only the qti_text of each version is created
+        shuffle_seed  : seed for the answer shuffles. If None, one is drawn from the global RNG. 
+        cache_dir     : directory for the QTI item cache. Items that have not changed since 
+                        the last export are reused. Defaults to the cache_dir used for the 
+                        question, then the APGEN_CACHE_DIR environment variable. 
+        compact       : write the XML without indentation or line breaks between tags
+        '''
         from apgen.qti_convert import makeQTI
         import os
         
         # Get the contents of the save directory. 
         if overwrite == False:
-            contents = os.listdir(path)
+            contents = os.listdir(path or '.')
             contents = [x for x in contents if '.zip' in x]
             conflicts = [x for x in contents if self.id in x]
             nums = [0]
@@ -862,122 +1213,658 @@ class Question:
                 
             self.id = self.id + f'_v{max(nums)+1:02}'
         
-        convertor = makeQTI(self, path=path, shuffle=shuffle)
+        # shuffle_seed makes the answer order (and the package) reproducible. 
+        if cache_dir is None:
+            cache_dir = self.cache_dir
+        convertor = makeQTI(self, path=path, shuffle=shuffle, shuffle_seed=shuffle_seed, cache_dir=cache_dir, compact=compact)
+        self.qti_options = {'shuffle': shuffle, 'seeds': seeds, 'shuffle_seed': convertor.shuffle_seed, 'compact': compact}
         convertor.run(create_files=create_files, seeds=seeds)
         
         if save_template and create_files:
-            with open(f'{path}/{self.id}.txt', 'w', encoding="utf-8") as f:
+            # Write to a temporary file and rename, as with the QTI package. 
+            fname = os.path.join(path, f'{self.id}.txt')
+            tmp_fname = f'{fname}.{os.getpid()}.tmp'
+            with open(tmp_fname, 'w', encoding="utf-8") as f:
                 f.write(self.qt)
+            os.replace(tmp_fname, fname)
         
         if create_files and verbose:
             print('QTI file created successfully')
         
+
+class Version(dict):
+    '''
+    Dictionary storing a single version of a question. 
+    
+    Only the status, seed, variable values and formatted fields are stored. 
+    The entries in LAZY_KEYS are rendered from the fields by the question 
+    when first accessed and cached subject to Question.text_cache_size. 
+    Values assigned to these keys directly (v['text'] = ...) are kept as they 
+    are and are never dropped from the cache. 
+    Versions are pickled without their question, so the question needs to 
+    be reattached (see Question.__finalize_versions__) after unpickling. 
+    '''
+    
+    LAZY_KEYS = ('text', 'colab_text', 'answer_options', 'colab_answer_options', 'qti_text')
+    
+    def __init__(self, question=None, **kwargs):
+        super().__init__(**kwargs)
+        self.question = question
+        self.index = None           # Position in question.versions, set when finalized
+        self.edited = set()         # Lazy keys that were assigned directly
+    
+    def __getitem__(self, key):
+        if key in Version.LAZY_KEYS and self.question is not None:
+            return self.question.__render_version__(self, key)
+        return dict.__getitem__(self, key)
+    
+    def __setitem__(self, key, value):
+        if key in Version.LAZY_KEYS:
+            self.edited.add(key)
+        dict.__setitem__(self, key, value)
+    
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (key in Version.LAZY_KEYS and self.question is not None)
+    
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+    
+    def clear_text(self):
+        '''
+        Drops any cached text. It will be rendered again when next accessed. 
+        Values that were assigned directly are kept. 
+        '''
+        for k in Version.LAZY_KEYS:
+            if k not in self.edited:
+                dict.pop(self, k, None)
+    
+    def __reduce__(self):
+        items = [(k, v) for k, v in dict.items(self) if k not in Version.LAZY_KEYS or k in self.edited]
+        return (Version, (), {'edited': set(self.edited)}, None, iter(items))
+
+
+def question_name(q):
+    '''
+    Returns the name used for files written for a question: its id, or the 
+    template key if the template does not set an id. 
+    '''
+    from apgen.cache import template_key
+    return getattr(q, 'id', None) or template_key(q.qt)
+
+
+NAME_PATTERN = re.compile(r'__NAMEa__.*?__NAMEb__')
+
+def duplicate_key(version):
+    '''
+    Returns the key used to detect duplicate versions. This is made up of the 
+    fields that appear in the question text, which determine the text. Names 
+    are stripped out since they mess up the duplicate checking process. 
+    '''
+    q = version.question
+    fields = version['fields']
+    return tuple(NAME_PATTERN.sub('', fields[i]) for i in q.text_fields)
+
+
+def compile_source(source, filename, mode):
+    '''
+    Compiles template code. If the code contains a syntax error, the source is 
+    returned unchanged so that the error is raised (and logged) when the code 
+    is executed during version generation. 
+    '''
+    try:
+        return compile(source, filename, mode)
+    except SyntaxError:
+        return source
+
       
-def insert_vars(text, scope):
-    a = 0
-    b = 0
-    temp = text
-    new_text = ''
-    
-    while len(temp) > 0:
-        if len(temp) < 3:
-            new_text += temp
-            break        
-        
-        a = temp.find('[[')
-        while temp[a+2] == '[':
+def compile_text(text, var_delim='[[ ]]'):
+    '''
+    Splits text into a list of segments. Literal text is stored as strings and 
+    each placeholder is stored as a tuple (expression, code, format), where 
+    format is None if the placeholder has no format string. 
+    
+    This is done once per template. Rendering a version is then a single join 
+    over the segments (see render_segments). 
+    '''
+    open_delim, close_delim = var_delim.split()
+    segments = []
+    literal = ''
+    i = 0
+    
+    while True:
+        
+        #-----------------------------------------------------------
+        # Find the next opening delimiter. Extra opening brackets
+        # (for example, [[[x]]) are treated as literal text. 
+        #-----------------------------------------------------------
+        a = text.find(open_delim, i)
+        if a == -1:
+            break
+        while text.startswith(open_delim, a+1):
             a += 1
         
-        # count [ before next ]
-        k = temp.find(']')
-        n = 0
-        for i in range(a+2, k):
-            if temp[i] == '[': 
-                n += 1
-                
-        # Skip 'interior' closing brackets
-        x = a
-        for i in range(n):
-            x = temp.find(']', x+1)
+        #-----------------------------------------------------------
+        # Find the matching closing delimiter, skipping over any 
+        # brackets that are part of the expression, such as x[0].
+        #-----------------------------------------------------------
+        j = a + len(open_delim)
+        depth = 0
+        b = -1
+        while j < len(text):
+            if depth == 0 and text.startswith(close_delim, j):
+                b = j
+                break
+            if text[j] == '[': depth += 1
+            elif text[j] == ']': depth -= 1
+            j += 1
         
-        b = temp.find(']]', x+1)
-                
-        if a == -1 or b == -1:
-            new_text += temp 
+        if b == -1:
             break
         
-        var_string = temp[a+2:b]      
-        new_text += temp[:a]
-        new_text += evaluate_and_format_var(var_string, scope)            
+        #-----------------------------------------------------------
+        # Store the literal text and the compiled placeholder
+        #-----------------------------------------------------------
+        literal += text[i:a]
+        if literal != '':
+            segments.append(literal)
+            literal = ''
+        
+        tokens = text[a+len(open_delim):b].split(':')
+        fmt = tokens[1] if len(tokens) > 1 else None
+        segments.append((tokens[0], compile_source(tokens[0], '<placeholder>', 'eval'), fmt))
+        
+        i = b + len(close_delim)
+    
+    literal += text[i:]
+    if literal != '':
+        segments.append(literal)
+    
+    return segments
+
+
+def split_table_row(line, var_delim='[[ ]]'):
+    '''
+    Splits a row of a TABLE section on |. A | inside a placeholder or an 
+    equation (for example $|x|$) does not start a new cell. Elsewhere, \\| is 
+    an escaped | and is shown as |. 
+    '''
+    open_delim, close_delim = var_delim.split()
+    cells = []
+    start = 0
+    eqn = None      # '$' or '$$' while inside an equation
+    escapes = []    # Positions of the backslashes in \| outside equations
+    i = 0
+    
+    def cell(a, b):
+        # Text of the cell from a to b, with escaped pipes unescaped. 
+        parts = []
+        for k in escapes:
+            if a <= k < b:
+                parts.append(line[a:k])
+                a = k + 1
+        parts.append(line[a:b])
+        return ''.join(parts)
+    
+    while i < len(line):
+        # Skip over placeholders, using the same bracket matching as compile_text. 
+        if line.startswith(open_delim, i):
+            j = i + len(open_delim)
+            depth = 0
+            while j < len(line) and not (depth == 0 and line.startswith(close_delim, j)):
+                if line[j] == '[': depth += 1
+                elif line[j] == ']': depth -= 1
+                j += 1
+            i = j + len(close_delim)
+            continue
+        
+        c = line[i]
+        if c == '\\':
+            if eqn is None and line.startswith('|', i + 1):
+                escapes.append(i)
+            i += 2
+            continue
+        if c == '$':
+            d = '$$' if line.startswith('$$', i) else '$'
+            if eqn is None: 
+                eqn = d
+                opened = (i, start, len(cells))
+            elif eqn == d: 
+                eqn = None
+            i += len(d)
+            continue
+        if c == '|' and eqn is None:
+            cells.append(cell(start, i))
+            start = i + 1
+        i += 1
+    
+    if eqn is not None:
+        # Unmatched $. The rest of the row is split as if it were not there. 
+        i, start, n = opened
+        rest = split_table_row(line[i+len(eqn):], var_delim)
+        rest[0] = cell(start, i+len(eqn)) + rest[0]
+        return cells[:n] + rest
+    
+    cells.append(cell(start, len(line)))
+    return cells
+
+
+def table_config_value(v):
+    '''
+    Converts a value from the config line of a TABLE section, such as 60 or 
+    [40, 60, 60]. Values that are not literals are evaluated as before. 
+    '''
+    try:
+        return ast.literal_eval(v)
+    except (ValueError, SyntaxError):
+        return eval(v)
+
+
+def render_segments(segments, scope):
+    '''
+    Renders a list of segments created by compile_text using the variables in scope. 
+    '''
+    return ''.join([s if type(s) is str else compile_format(s[2])(eval(s[1], scope)) for s in segments])
+
+
+def share_placeholders(segment_lists):
+    '''
+    Finds identical placeholders across several segment lists (such as the text 
+    and answer options of a template), so that each is only evaluated and 
+    formatted once per version. 
+    
+    Returns three items:
+      exprs    : list of distinct (expression, code) pairs
+      fields   : list of distinct (expression index, format) pairs
+      segments : the segment lists with each placeholder replaced by its field index
+    '''
+    import ast
+    
+    exprs, expr_index = [], {}
+    fields, field_index = [], {}
+    new_lists = []
+    
+    for segments in segment_lists:
+        new_segments = []
+        for s in segments:
+            if type(s) is str:
+                new_segments.append(s)
+                continue
+            
+            # Expressions that differ only in spacing are the same expression
+            expr = s[0].strip()
+            try:
+                key = ast.dump(ast.parse(expr, mode='eval'))
+            except SyntaxError:
+                key = expr
+            
+            if key not in expr_index:
+                expr_index[key] = len(exprs)
+                exprs.append((expr, s[1]))
+            
+            pair = (expr_index[key], s[2])
+            if pair not in field_index:
+                field_index[pair] = len(fields)
+                fields.append(pair)
+            new_segments.append(field_index[pair])
         
-        temp = temp[b+2:]
+        new_lists.append(new_segments)
+    
+    return exprs, fields, new_lists
+
+
+def render_fields(exprs, fields, scope):
+    '''
+    Evaluates each distinct expression once and formats each distinct 
+    expression+format pair once. Returns the list of formatted fields. 
+    '''
+    values = [eval(code, scope) for expr, code in exprs]
+    return [compile_format(fmt)(values[i]) for i, fmt in fields]
+
+
+def join_segments(segments, fields):
+    '''
+    Assembles text from a segment list whose placeholders have been replaced 
+    by field indices (see share_placeholders). 
+    '''
+    return ''.join([s if type(s) is str else fields[s] for s in segments])
+
+
+#----------------------------------------------------------------------
+# KaTeX delimiters. 
+# In Colab, equations are rendered by KaTeX auto-render (see autorender.py), 
+# which looks for __EQN__ and __DEQN__ rather than dollar signs. Escaped 
+# dollar signs become plain dollar signs. 
+#----------------------------------------------------------------------
+
+KATEX_PATTERN = re.compile(r'\\\$|\$\$|\$')
+KATEX_DELIMITERS = {'\\$': '$', '$$': '__DEQN__', '$': '__EQN__'}
+
+def katex_delimiters(text):
+    return KATEX_PATTERN.sub(lambda m: KATEX_DELIMITERS[m.group(0)], text)
+
+# KaTeX is loaded from the CDN by the files written by Question.export_html. 
+KATEX_CDN = 'https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/'
+KATEX_INCLUDE = (
+    f'<link rel="stylesheet" href="{KATEX_CDN}katex.min.css">\n'
+    f'<script src="{KATEX_CDN}katex.min.js"></script>\n'
+)
+
+
+#----------------------------------------------------------------------
+# CSS classes. 
+# The text created for a template repeats the same inline styles on 
+# every paragraph, list item and table cell. css_classes replaces each 
+# style attribute with a class named after a hash of the style, so the 
+# same style always gets the same class, in any question. 
+#----------------------------------------------------------------------
+
+TAG_PATTERN = re.compile(r'<[a-zA-Z][^<>]*>')
+STYLE_PATTERN = re.compile(r'\sstyle="([^"]*)"')
+
+def style_class(style):
+    return 'ap-' + hashlib.md5(style.encode('utf-8')).hexdigest()[:8]
+
+
+def css_classes(text, styles):
+    '''
+    Replaces the style attributes of the tags in text with classes. Tags that 
+    already have a class are left alone. The styles used are added to the 
+    dict styles as {class: style}. 
+    '''
+    def replace(m):
+        tag = m.group(0)
+        attr = STYLE_PATTERN.search(tag)
+        if attr is None or 'class=' in tag:
+            return tag
+        name = style_class(attr.group(1))
+        styles[name] = attr.group(1)
+        return tag[:attr.start()] + f' class="{name}"' + tag[attr.end():]
+    
+    return TAG_PATTERN.sub(replace, text)
+
+
+def stylesheet(styles):
+    if len(styles) == 0:
+        return ''
+    rules = ' '.join(f'.{name} {{ {style} }}' for name, style in sorted(styles.items()))
+    return f'<style>{rules}</style>\n'
+
+
+def render_columns(segments, columns, n=None):
+    '''
+    Renders many versions of a list of segments at once. 
+    
+    PARAMETERS
+    segments : list of segments created by compile_text
+    columns  : columnar table of variable values, such as a dict mapping each 
+               variable name to a sequence of values (one per version) or a DataFrame
+    n        : number of versions. Determined from the columns if not provided. 
+    
+    Each placeholder is evaluated and formatted as a whole column, using NumPy 
+    string formatting where possible. The texts are then assembled in one pass. 
+    '''
+    if n is None:
+        n = len(columns[list(columns)[0]])
+    
+    exprs, fields, (segments,) = share_placeholders([segments])
+    field_columns = render_field_columns(exprs, fields, columns, n)
+    return assemble_columns(segments, field_columns, n)
+
 
-    return new_text
+def render_field_columns(exprs, fields, columns, n):
+    '''
+    Columnar version of render_fields. Returns one list of formatted values 
+    (one per version) for each field. 
+    '''
+    value_columns = [evaluate_column(expr, code, columns, n) for expr, code in exprs]
+    return [format_column(value_columns[i], fmt) for i, fmt in fields]
+
+
+def assemble_columns(segments, field_columns, n):
+    '''
+    Columnar version of join_segments. Assembles all n texts in one pass. 
+    '''
+    import itertools
+    
+    parts = [itertools.repeat(s, n) if type(s) is str else field_columns[s] for s in segments]
+    if len(parts) == 0:
+        return [''] * n
+    return [''.join(row) for row in zip(*parts)]
+
+
+def evaluate_column(expr, code, columns, n):
+    '''
+    Evaluates a placeholder expression for every row of a columnar table. 
+    Names and arithmetic on numeric columns are evaluated on whole arrays. 
+    Anything else is evaluated one row at a time. 
+    '''
+    import ast
+    
+    #-------------------------------------------------------------
+    # Placeholder is a single variable
+    #-------------------------------------------------------------
+    name = expr.strip()
+    if name in columns:
+        return columns[name]
+    
+    #-------------------------------------------------------------
+    # Placeholder is arithmetic on numeric columns
+    #-------------------------------------------------------------
+    try:
+        tree = ast.parse(name, mode='eval')
+    except SyntaxError:
+        tree = None
+    
+    if tree is not None:
+        allowed = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load, ast.Constant, ast.operator, ast.unaryop)
+        nodes = list(ast.walk(tree))
+        names = {node.id for node in nodes if isinstance(node, ast.Name)}
+        simple = all(isinstance(node, allowed) for node in nodes) and len(names) > 0 and names <= set(columns)
+        
+        if simple:
+            arrays = {k:np.asarray(columns[k]) for k in names}
+            if all(a.ndim == 1 and a.dtype.kind in 'iuf' for a in arrays.values()):
+                try:
+                    with np.errstate(all='raise'):
+                        result = eval(code, {'__builtins__': {}}, arrays)
+                    if np.shape(result) == (n,) and not (result.dtype.kind in 'iu' and int_overflow(code, arrays, result)):
+                        return result
+                except (ArithmeticError, FloatingPointError, ValueError, TypeError):
+                    pass
+    
+    #-------------------------------------------------------------
+    # Evaluate one row at a time
+    #-------------------------------------------------------------
+    scope = {}
+    exec('from apgen.functions import *', scope)
+    keys = list(columns)
+    values = []
+    for row in zip(*[columns[k] for k in keys]):
+        scope.update(zip(keys, row))
+        values.append(eval(code, scope))
+    return values
+
+
+def int_overflow(code, arrays, result):
+    '''
+    Integer arithmetic on arrays wraps around silently on overflow. Checks an 
+    integer result against the same expression evaluated with floats, and 
+    returns True if they do not agree (in which case the values are computed 
+    one row at a time, with Python ints). 
+    '''
+    with np.errstate(all='ignore'):
+        check = eval(code, {'__builtins__': {}}, {k:a.astype(np.float64) for k, a in arrays.items()})
+    if not np.isfinite(check).all():
+        return True
+    return not (np.abs(check) < 2**62).all() or not np.allclose(result, check, rtol=1e-9, atol=0.5)
+
+
+def format_column(values, formatting=None):
+    '''
+    Formats a column of values. Integer and float64 arrays with no format string or 
+    a format string that only contains a number of digits are formatted with NumPy. Values 
+    where NumPy's result could differ from the compiled formatter (values that 
+    need rounding to 10 places, or that are close to a rounding tie) and all other 
+    columns are formatted one value at a time. 
+    '''
+    formatter = compile_format(formatting)
+    
+    arr = np.asarray(values) if isinstance(values, (list, tuple, np.ndarray)) else None
+    vectorize = (arr is not None and arr.ndim == 1 and (arr.dtype.kind in 'iu' or arr.dtype == np.float64)
+                 and np.isfinite(arr).all()
+                 and (formatting is None or (formatting.isdigit() and int(formatting) < 10)))
+    if not vectorize:
+        return [formatter(v) for v in values]
+    
+    #-------------------------------------------------------------
+    # Integers
+    #-------------------------------------------------------------
+    if arr.dtype.kind in 'iu':
+        if formatting is None:
+            return arr.astype(str).tolist()
+        return np.char.mod(f'%.{formatting}f', arr).tolist()
+    
+    # Same rounding as normalize_value. Adding 0.0 turns -0.0 into 0.0. 
+    # The formatter is still given the original values. 
+    original = arr
+    arr = np.round(arr, 10) + 0.0
+    
+    #-------------------------------------------------------------
+    # Floats with no format string. Integer values are shown without decimals.
+    #-------------------------------------------------------------
+    if formatting is None:
+        out = arr.astype(str)
+        integral = (arr == np.trunc(arr)) & (np.abs(arr) < 2**53)
+        out[integral] = arr[integral].astype(np.int64).astype(str)
+        out = out.tolist()
+        for i, x in enumerate(out):
+            if 'e' in x or ('.' in x and len(x) - x.index('.') > 11):
+                out[i] = formatter(original[i])
+        return out
+    
+    #-------------------------------------------------------------
+    # Floats with a number of digits
+    #-------------------------------------------------------------
+    digits = int(formatting)
+    out = np.char.mod(f'%.{digits}f', arr).tolist()
+    scaled = np.abs(arr) * 10**digits
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-9 * max(1, 10**digits)
+    for i in np.flatnonzero(near_tie):
+        out[i] = formatter(original[i])
+    return out
+
+      
+def insert_vars(text, scope):
+    return render_segments(compile_text(text), scope)
 
 
 def evaluate_and_format_var(x, scope):
-    import re
     
     # Variable string on ":"
     tokens = x.split(':')
     
     # Determine value of variable or expression.
-    # Need to re-round values if evaluating an expression
-    var_name = tokens[0]
-    value = eval(var_name, scope)  
+    value = eval(tokens[0], scope)
+    formatting = tokens[1] if len(tokens) > 1 else None
     
-    if type(value) == np.str_: value = str(value)
-    elif type(value) == np.float64: value = float(value)
-    elif type(value) == np.int32: value = int(value)
+    return format_value(value, formatting)
+
+
+def format_value(value, formatting=None):
+    return compile_format(formatting)(value)
+
+
+def normalize_value(value):
+    '''
+    Converts NumPy scalars to Python values and gets rid of precision/rounding 
+    issues. Need to re-round values if evaluating an expression. 
+    '''
+    # float32 and float16 are shown the way NumPy prints them (8.8, not 8.8000001907). 
+    if isinstance(value, np.floating) and value.dtype != np.float64:
+        return float(str(value))
+    
+    if isinstance(value, np.generic): 
+        value = value.item()
     
     if type(value) == float:
         value = round(value, 10)
         if value == int(value):
             value = int(value)
     
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def compile_format(formatting=None):
+    '''
+    Compiles a format string (the part of a placeholder after the colon) into a 
+    function that formats a single value. Each distinct format string is only 
+    parsed once. 
     
-    # Return if there is no format string
-    if len(tokens) == 1:
-        return str(value)
+    Format strings can contain:
+      digits : number of decimal places
+      ,      : always add commas
+      ,,     : add commas only if the value is at least 10,000
+      a      : leading coefficient       ( 1 --> '',   -1 --> '-',  x --> x)
+      b      : non-leading coefficient   ( 1 --> '+ ', -1 --> '- ', x --> + x)
+      c      : additive constant         ( x --> + x,  -x --> - x)
+    '''
     
+    # Return if there is no format string
+    if formatting is None:
+        return lambda value: str(normalize_value(value))
     
     #--------------------------------
-    # Apply Formatting 
+    # Parse the format string
     #--------------------------------
-    formatting = tokens[1]
-
+    
     # Get the number of digits to round to. 
     digits = re.sub('[^0-9]', '', formatting)
     rounding = f'.{digits}f' if digits != '' else ''
     
     # Detemrine if commas need to be added. 
-    b1 = (',' in formatting) and (',,' not in formatting)
-    b2 = (',,' in formatting) and (int(value) >= 10_000)
-    comma = ',' if b1 or b2 else ''
+    always_comma = (',' in formatting) and (',,' not in formatting)
+    large_comma = (',,' in formatting)
+    spec = (',' if always_comma else '') + rounding
+    comma_spec = ',' + rounding
     
-    raw_f_string = 'f"{'   +   f'{value}:{comma}{rounding}'  +   '}"'
-    formatted_value = eval(raw_f_string)
+    # Determine coefficient style
+    lower = formatting.lower()
+    style = 'a' if 'a' in lower else 'b' if 'b' in lower else 'c' if 'c' in lower else None
     
-    # Check to see if number is a leading coefficient
-    if 'a' in formatting.lower():
-        if value == 1: return ''                          #  1 --> ''
-        if value == -1: return '-'                        # -1 -->  -
-        if value >= 0: return formatted_value             #  x -->  x    
-        if value < 0: return  formatted_value             # -x --> -x
-    
-    # Check to see if number is a non-leading coefficient
-    if 'b' in formatting.lower():
-        if value == 1: return '+ '                        #  1 -->  +
-        if value == -1: return '- '                       # -1 -->  -
-        if value >= 0: return '+ ' + formatted_value      #  x --> +x    
-        if value < 0: return  '- ' + formatted_value[1:]  # -x --> -x
-        
-    # Check to see if number is a additive constant
-    if 'c' in formatting.lower():
-        if value >= 0: return '+ ' + formatted_value      #  x --> +x    
-        if value < 0: return  '- ' + formatted_value[1:]  # -x --> -x
-
-    return formatted_value
+    #--------------------------------
+    # Create the formatter
+    #--------------------------------
+    def formatter(value):
+        value = normalize_value(value)
+        
+        if large_comma and int(value) >= 10_000:
+            formatted_value = format(value, comma_spec)
+        else:
+            formatted_value = format(value, spec)
+        
+        # Check to see if number is a leading coefficient
+        if style == 'a':
+            if value == 1: return ''                          #  1 --> ''
+            if value == -1: return '-'                        # -1 -->  -
+            if value >= 0: return formatted_value             #  x -->  x    
+            if value < 0: return  formatted_value             # -x --> -x
+        
+        # Check to see if number is a non-leading coefficient
+        if style == 'b':
+            if value == 1: return '+ '                        #  1 -->  +
+            if value == -1: return '- '                       # -1 -->  -
+            if value >= 0: return '+ ' + formatted_value      #  x --> +x    
+            if value < 0: return  '- ' + formatted_value[1:]  # -x --> -x
+            
+        # Check to see if number is a additive constant
+        if style == 'c':
+            if value >= 0: return '+ ' + formatted_value      #  x --> +x    
+            if value < 0: return  '- ' + formatted_value[1:]  # -x --> -x
+        
+        return formatted_value
+    
+    return formatter
 
 
 #-----------------------------------------
@@ -1,3 +1,4 @@
+import functools
 import numpy as np
 import scipy.stats
 
@@ -512,19 +513,48 @@ def TABLE(contents, config=None, rlab=None, clab=None, inc_margin=True):
     for k,v in default_config.items():
         if k not in config.keys():
             config[k] = v
-        
-    tm = 20 if inc_margin else 0
-    t = '<table style="border:1px solid black;  border-spacing:0px; border-collapse: collapse; '
-    t += f'background-color:#FFFFFF; ; margin: 20px 0px 20px 0px;"">\n'
-    t += '<tbody>\n'
     
+    # -----------------------------------------
+    # Get the cell values, with labels added
+    # -----------------------------------------
+    cells = _table_cells(contents, rlab, clab)
+    n_row = len(cells)
+    n_col = len(cells[0]) if n_row > 0 else 0
+    
+    # -----------------------------------------
+    # Fill the cells into the skeleton for this layout
+    # -----------------------------------------
+    key = (n_row, n_col, _table_key(config['cw']), _table_key(config['ch']), 
+           _table_key(config['align']), config['sr1'], config['sc1'])
+    try:
+        static = _table_skeleton(*key)
+    except TypeError:
+        # Unhashable config values can't be cached. 
+        static = _table_skeleton.__wrapped__(*key)
+    
+    parts = [None] * (2 * n_row * n_col + 1)
+    parts[0::2] = static
+    parts[1::2] = [x for row in cells for x in row]
+    return ''.join(parts)
+
+
+def _table_cells(contents, rlab=None, clab=None):
+    '''
+    Returns the cells of a table as a list of rows of strings. Contents given as 
+    rows of strings (as in TEXT tables) are used directly. Anything else goes 
+    through numpy, so that values are converted the same way as before. 
+    '''
+    # Single column tables go through numpy too, since they get an extra blank row (Step 2). 
+    if (rlab is None and clab is None and type(contents) == list and len(contents) > 0 
+        and all(type(row) == list for row in contents) and len(contents[0]) > 1
+        and all(len(row) == len(contents[0]) for row in contents)
+        and all(type(x) == str for row in contents for x in row)):
+        return contents
     
     if rlab is None: rlab = []
     if clab is None: clab = []
     rlab = np.array(rlab).reshape((-1,1))
     clab = np.array(clab).reshape((1,-1))
-    #row_labels = np.array([]) if row_labels is None else np.array(row_labels).reshape((-1,1))
-    #col_labels = np.array([]) if col_labels is None else np.array(col_labels).reshape((1,-1))
     contents = np.array(contents)
     if contents.ndim == 1:
         contents = contents.reshape([1,-1])
@@ -559,59 +589,56 @@ def TABLE(contents, config=None, rlab=None, clab=None, inc_margin=True):
     if len(rlab) == contents.shape[0] and row_labels_added == False:
         contents = np.hstack([rlab, contents])
     
-    
-    
-    # Fold labels into contents:
-    # Current assumes that upper right cell belows to row labels
-    #new_contents = contents.copy()
-    #if col_labels is not None:
-    #    new_contents.insert(0, col_labels)
-    #if row_labels is not None:
-    #   for i, rl in enumerate(row_labels):
-    #        new_contents[i].insert(0,rl)
+    # tolist gives Python values that format the same as the numpy ones, 
+    # except for floats smaller than float64. 
+    if contents.dtype.kind == 'U':
+        return contents.tolist()
+    if contents.dtype.kind == 'f' and contents.dtype != np.float64:
+        return [[f'{x}' for x in row] for row in contents]
+    return [[f'{x}' for x in row] for row in contents.tolist()]
 
+
+def _table_key(v):
+    # Lists in the config hold one value per row or column. 
+    return ('list', tuple(v)) if type(v) == list else v
+
+
+@functools.lru_cache(maxsize=256)
+def _table_skeleton(n_row, n_col, cw, ch, align, sr1, sc1):
+    '''
+    Returns the static parts of the HTML for a table with the given layout. 
+    The cell values go between consecutive parts. 
+    '''
+    def pick(v, k):
+        return v[1][k] if type(v) == tuple and v[:1] == ('list',) else v
     
+    static = []
+    t = '<table style="border:1px solid black;  border-spacing:0px; border-collapse: collapse; '
+    t += f'background-color:#FFFFFF; ; margin: 20px 0px 20px 0px;"">\n'
+    t += '<tbody>\n'
     
-    
-    
-    
-    
-    # -----------------------------------------
-    # Add contents
-    # -----------------------------------------
-    for i, row in enumerate(contents):
-        # Determine height
-        temp = config['ch']
-        ch = temp[i] if type(temp) == list else temp
-
+    for i in range(n_row):
         # Start row
-        t += f'    <tr style="height:{ch}px">\n'
+        t += f'    <tr style="height:{pick(ch, i)}px">\n'
         
-        for j, x in enumerate(row):
-
-            # Determine Cell Color
-            col = '#FFFFFF'
-            if (config['sr1'] and i == 0) or (config['sc1'] and j == 0):
-                col = '#E0E0E0'
-                x = f'<b>{x}</b>'
-
-            # Determine width
-            temp = config['cw']
-            cw = temp[j] if type(temp) == list else temp
+        for j in range(n_col):
+            # Cell color. Header cells are bold. 
+            header = (sr1 and i == 0) or (sc1 and j == 0)
+            col = '#E0E0E0' if header else '#FFFFFF'
+            a = {'C':'center', 'L':'left', 'R':'right'}[pick(align, j)]
             
-            # Alignment
-            temp = config['align']
-            align = temp[j] if type(temp) == list else temp
-            a = {'C':'center', 'L':'left', 'R':'right'}[align]
-                
             t += f'        <td  style="border:1px solid black; background-color:{col}; '
-            t += f'width:{cw}px; text-align:{a}">'
-            t += f'{x}</td>\n'
+            t += f'width:{pick(cw, j)}px; text-align:{a}">'
+            t += '<b>' if header else ''
+            static.append(t)
+            t = '</b></td>\n' if header else '</td>\n'
 
         t += '    </tr>\n'
     t += '</tbody>\n</table>'
+    static.append(t)
     
-    return t
+    return tuple(static)
+
 
 def ANNUITY_PV(n, i, due=False):
     v = 1/(1+i)
@@ -30,33 +30,23 @@ brandon.e.jackson@gmail.com
 
 
 import argparse
+import contextlib
+import functools
+import os
 from pathlib import Path
 import shutil
 import zipfile
 import re
 import html
 import re
-import xml.etree.ElementTree as ET
 import subprocess
 import urllib.parse
 import sys
 import uuid
 
+from apgen.core import join_segments
+from apgen.cache import load_items, save_items
 
-def indent(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
 
 '''
 def errorNoImage(q):
@@ -89,31 +79,300 @@ def logDisplay():
         print(applescript)
 
 
+
+#----------------------------------------------------------------------
+# Equation processing. 
+# Equations are converted to Canvas equation images. Equations that 
+# contain no placeholders are the same in every version, so they are 
+# converted once when the template is parsed (see hoist_equations). 
+#----------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=4096)
+def equation_markup(eqn_text, display):
+    '''
+    Returns the Canvas image markup for a LaTeX equation. Results are cached 
+    since the same equations appear in many versions and questions. 
+    '''
+    # Not sure what this stuff is for, really. 
+    neweq = urllib.parse.quote(eqn_text)
+    neweq = neweq.replace('%', '%25')
+    
+    new_text =  f'<img class="equation_image" title="{eqn_text}" '
+    new_text += f'src="/equation_images/{neweq}?scale=1" alt="LaTeX: {eqn_text}" '
+    if display:
+        new_text += f'data-equation-content="{eqn_text}" data-ignore-a11y-check="">'
+    else:
+        new_text += f'data-equation-content="{eqn_text}" data-ignore-a11y-check="" />'
+    return new_text
+
+
+def process_equations(text, skip=None):
+    '''
+    Replaces $$...$$ and $...$ in text with equation images. Escaped dollar 
+    signs (\\$) are left as dollar signs. 
+    
+    All $$...$$ equations are replaced before any $...$ equations. Each step 
+    is a single scan over the text. 
+    
+    If skip is provided, equations containing that string are left as they are, 
+    and escaped dollar signs are left as __DS__. This is used by hoist_equations. 
+    In this case None is returned if a $$...$$ equation contains a $, since the 
+    pairing of the remaining dollar signs then depends on the equation markup. 
+    '''
+    text = text.replace(r'\$','__DS__')
+    
+    #-------------------------------------------------------------
+    # Replace $$...$$
+    # An equation runs from a $$ to the next $$ starting one character 
+    # later (so $$$ is an empty equation), but only if a second $$ 
+    # that does not overlap the first exists. 
+    #-------------------------------------------------------------
+    out = []
+    pos = 0
+    while True:
+        i = text.find('$$', pos)
+        if i == -1 or text.find('$$', i+2) == -1:
+            break
+        j = text.find('$$', i+1)
+        
+        eqn_text = text[i+2:j]
+        if skip is not None and '$' in eqn_text:
+            return None
+        if skip is not None and skip in eqn_text:
+            new_text = '\x01\x01' + eqn_text + '\x01\x01'
+        else:
+            new_text = equation_markup(eqn_text, True)
+        
+        out += [text[pos:i], new_text]
+        pos = j + 2
+    out.append(text[pos:])
+    text = ''.join(out)
+    
+    #-------------------------------------------------------------
+    # Replace $...$
+    # Dollar signs pair up in order. An unpaired final $ is left as is. 
+    #-------------------------------------------------------------
+    parts = text.split('$')
+    out = [parts[0]]
+    for k in range(1, len(parts) - 1, 2):
+        eqn_text = parts[k]
+        if skip is not None and skip in eqn_text:
+            out.append('\x01' + eqn_text + '\x01')
+        else:
+            out.append(equation_markup(eqn_text, False))
+        out.append(parts[k+1])
+    if len(parts) % 2 == 0:
+        out += ['$', parts[-1]]
+    text = ''.join(out)
+    
+    if skip is not None:
+        return text.replace('\x01', '$')
+    
+    text = text.replace('__DS__', '$')
+    
+    return text
+
+
+#----------------------------------------------------------------------
+# Markdown formatting. 
+# Bold, italics and superscripts are replaced in that order, as pairs 
+# of markers in the whole text. Escaping html characters does not affect 
+# the markers, so the text is escaped first and the escaped tags are 
+# inserted directly. 
+#----------------------------------------------------------------------
+
+BOLD_PATTERN = re.compile(r'\*\*(.+?)\*\*', re.S)
+ITALIC_PATTERN = re.compile(r'\*(.+?)\*', re.S)
+SUP_PATTERN = re.compile(r'\^(.+?)\^', re.S)
+IMAGE_PATTERN = re.compile(r'^\s*image:\s*(.*)$')
+
+def process_formatting(text):
+    '''
+    Converts **bold**, *italics* and ^superscripts^ to html tags and escapes 
+    the result so it can be placed in a QTI mattext element. 
+    '''
+    text = html.escape(text)
+    if '*' in text:
+        text = BOLD_PATTERN.sub(r'&lt;strong&gt;\1&lt;/strong&gt;', text)
+        text = ITALIC_PATTERN.sub(r'&lt;em&gt;\1&lt;/em&gt;', text)
+    if '^' in text:
+        text = SUP_PATTERN.sub(r'&lt;sup&gt;\1&lt;/sup&gt;', text)
+    return text
+
+
+#----------------------------------------------------------------------
+# Answer shuffles. 
+# The permutations for all versions of a question are drawn at once. 
+# Permutations and letters use separate streams, so the values for a 
+# version do not depend on how many versions are exported after it. 
+#----------------------------------------------------------------------
+
+def make_shuffles(shuffle_seed, num_versions, num_answers):
+    '''
+    Returns an array with one permutation of the answer options per version, 
+    and a list with one random letter per version (used in item metadata). 
+    shuffle_seed can be an int or a list of ints. 
+    '''
+    import numpy as np
+    
+    perm_seq, letter_seq = np.random.SeedSequence(shuffle_seed).spawn(2)
+    base = np.tile(np.arange(num_answers), (num_versions, 1))
+    perms = np.random.default_rng(perm_seq).permuted(base, axis=1)
+    letters = np.random.default_rng(letter_seq).integers(0, 26, num_versions)
+    return perms, [chr(97 + k) for k in letters.tolist()]
+
+
+#----------------------------------------------------------------------
+# Slots are markers placed in generated XML where per-version values go. 
+# slot_template compiles the result into a function that fills the 
+# slots with a single f-string, with the static parts as constants. 
+#----------------------------------------------------------------------
+
+SLOT_PATTERN = re.compile('\x00(\\d+)\x00')
+
+def slots(n):
+    return [f'\x00{k}\x00' for k in range(n)]
+
+def slot_template(text):
+    parts = SLOT_PATTERN.split(text)    # static, slot, static, slot, ..., static
+    static = {}
+    source = []
+    for k, part in enumerate(parts):
+        if k % 2 == 1:
+            source.append(f'{{v[{part}]}}')
+        elif part != '':
+            static[f's{k}'] = part
+            source.append(f'{{s{k}}}')
+    return eval("lambda v: f'" + ''.join(source) + "'", static)
+
+
+def zip_entry(name):
+    '''
+    Returns a ZipInfo with a fixed timestamp, so packages are reproducible. 
+    '''
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+#----------------------------------------------------------------------
+# Compact output. 
+# The item templates are indented for readability, which adds a few 
+# hundred bytes to every item. In compact mode, whitespace between tags 
+# is removed. Text inside elements is escaped, so it never contains 
+# tags and is left alone. Whitespace-only answer text is kept. 
+#----------------------------------------------------------------------
+
+COMPACT_PATTERN = re.compile(r'>\s+<(?!/mattext>)')
+
+def compact_xml(text):
+    return COMPACT_PATTERN.sub('><', text.strip())
+
+
+#----------------------------------------------------------------------
+# Item cache. 
+# Items are cached with SEED_SLOT where the version seed span goes, and 
+# the span is filled in when the item is written. So exports that only 
+# differ in seeds ('hide' or 'show') can reuse the same cached items. 
+# The key covers everything else an item depends on: the template (which 
+# sets the type, margin and text), the field values, the item number, 
+# the version seed and the answer shuffle. 
+#----------------------------------------------------------------------
+
+SEED_SLOT = '\x00seed\x00'
+
+def seed_span(seeds, seed):
+    if seeds == 'hide':
+        return f'<span style="color:white; font-size:10px">[Version {seed}]</span>'
+    return f'<span style="font-size:10px">[Version {seed}]</span>'
+
+
+def fill_seed(fragment, seeds, seed):
+    '''
+    Returns a cached item with the seed span filled in. The question text is 
+    html escaped by process_formatting, so the span is escaped here as well. 
+    '''
+    if seeds in ['hide', 'show']:
+        return fragment.replace(SEED_SLOT, html.escape(seed_span(seeds, seed)))
+    return fragment
+
+
+def item_cache_key(qt_key, n, version, shuffle, seeds, perm, letter, compact=False, css=False):
+    from apgen.cache import item_key
+    
+    perm = None if perm is None else perm.tolist()
+    return item_key(qt_key, tuple(version['fields']), n, int(version['version_seed']), 
+                    bool(shuffle), seeds in ['hide', 'show'], perm, letter, bool(compact), bool(css))
+
+
+def hoist_equations(segments):
+    '''
+    Converts the equations in a list of text segments (see core.compile_text) 
+    that do not contain placeholders. Equations with placeholders are left to 
+    be processed for each version. Escaped dollar signs are left as __DS__ 
+    so the per-version call to process_equations restores them. 
+    
+    The result is only valid for versions where static_equations_valid 
+    returns True, since dollar signs in field values change the pairing. 
+    '''
+    skeleton = ''.join(s if isinstance(s, str) else '\x00' for s in segments)
+    skeleton = process_equations(skeleton, skip='\x00')
+    if skeleton is None:
+        return list(segments)
+    parts = skeleton.split('\x00')
+    fields = [s for s in segments if not isinstance(s, str)]
+    
+    hoisted = [parts[0]]
+    for f, part in zip(fields, parts[1:]):
+        hoisted += [f, part]
+    return [s for s in hoisted if s != '']
+
+
+def static_equations_valid(fields):
+    '''
+    Checks that no field value can change how the dollar signs in a text pair up. 
+    '''
+    for f in fields:
+        if f == '' or '$' in f or f.endswith('\\'):
+            return False
+    return True
+
+
 class makeQTI():
-        def __init__(self, q, path, shuffle):
-            if path[-1] == '/': path = path[:-1]
+        def __init__(self, q, path, shuffle, shuffle_seed=None, cache_dir=None, compact=False):
+            import numpy as np
+            from apgen.cache import item_cache_path, template_key
+            
+            if path.endswith('/'): path = path[:-1]
             self.q = q
             self.shuffle = shuffle
+            # Remove whitespace between tags in the item XML, see compact_xml. 
+            self.compact = compact
+            
+            # Answer shuffles are drawn from shuffle_seed (see make_shuffles). If no 
+            # seed is provided, one is drawn from the global RNG so that exports 
+            # can still be reproduced using np.random.seed. 
+            if shuffle_seed is None:
+                shuffle_seed = int(np.random.randint(2**31))
+            self.shuffle_seed = shuffle_seed
             
             self.path = Path(path)
             
             # set the outputfile and question bank name
-            self.bankName = q.id
+            self.bankName = getattr(q, 'id', 'question')
             self.questionType = q.type
             
-            # make a new directory to contain the output files
-            self.newDirPath = self.path / f'{self.bankName}_export'
-            self.newDirPath.mkdir(exist_ok = True)
-            
-            # self.newDirPath will contain images, imsmanifest.xml, and a folder that contains the main xml file
-            # make that folder
-            self.newXmlPath = self.newDirPath / self.bankName
-            self.newXmlPath.mkdir(exist_ok = True)
-            self.outFile = self.newXmlPath / self.bankName
-            self.outFile = self.outFile.with_suffix('.xml')
+            # The package is written by run() directly into a zip file. It contains 
+            # images, imsmanifest.xml, and a folder that contains the main xml file. 
+            self.zipFile = self.path / f'{self.bankName}_export.zip'
+            self.outFile = f'{self.bankName}/{self.bankName}.xml'
+            self.manFile = 'imsmanifest.xml'
             
-            # set the path of the manifest file in the root folder self.newDirPath
-            self.manFile = self.newDirPath / 'imsmanifest.xml'
+            # Cached item fragments, see make_item. item_cache is None if caching is disabled. 
+            self.itemPath = item_cache_path(self.bankName, cache_dir)
+            self.item_cache = None
+            self.items_used = {}
+            self.qt_key = template_key(q.qt) if self.itemPath is not None else None
             
             self.imagePath = ''
                                         
@@ -121,9 +380,8 @@ class makeQTI():
             self.header = ''
             self.footer = ''
             self.mainText = ''
-            self.manHeader = ''
-            self.manFooter = ''
-            self.manMainText = ''
+            # resources listed in the manifest, as (identifier, type, href, file) tuples
+            self.resources = []
             # initialize a blank list to hold all of the questions and answers from the file
             self.data = []
             # XML identifiers, don't think these actually matter
@@ -131,160 +389,176 @@ class makeQTI():
             # Initialize a list of question types
             self.typeList = ['MC', 'MA', 'MT', 'SA', 'MD', 'MB', 'ES', 'NUM', 'OR', 'TF', 'CT', 'HS']
             self.typeDict = {'MC':'multiple_choice_question', 'MA':'multiple_answers_question', 'SA': 'short_answer_question', 'ES': 'essay_question', 'MB': 'fill_in_multiple_blanks_question', 'MD': 'multiple_dropdowns_question', 'MT': 'matching_question', 'NUM': 'numerical_question', 'OR': 'ordering_question', 'TF': 'true_false_question', 'CT': 'categorization_question', 'HS' : 'hot_spot_question'}
-            # Initialize a counting variable to count images
+            # Item XML templates, see fillSkeleton
+            self.skeletons = {}
+            # Initialize a counting variable to count images, and a list of 
+            # (source path, name in package) pairs for the images to include 
             self.imNum = 0
+            self.images = []
             
                    
-        def run(self, create_files=True, seeds='hide'):
-            from IPython.core.display import HTML, display
-            import time
+        def run(self, create_files=True, seeds='hide', pretty=True):
             
             #-----------------------------------------------
             #  1.  Create Header and Footer.
             #-----------------------------------------------
             self.makeHeader()
             self.makeFooter()
+            if self.compact:
+                self.header = compact_xml(self.header)
+                self.footer = compact_xml(self.footer)
+                pretty = False
     
             #-----------------------------------------------
-            #  2.  Write header to files (move to the end)
+            #  2.  If no files are needed, just build the items
             #-----------------------------------------------
-            out_file_contents = self.header + '\n'
-            man_file_contents = self.manHeader + '\n'
-    
+            self.perms, self.letters = make_shuffles(self.shuffle_seed, len(self.q.versions), len(self.q.answer_segments))
+            
+            if self.itemPath is not None:
+                self.item_cache = load_items(self.itemPath)
+                self.items_used = {}
+            
+            if not create_files:
+                for n, version in enumerate(self.q.versions):
+                    qti_text = self.make_item(n, version, seeds, self.perms[n], self.letters[n])
+                    self.q.__cache_version_text__(version, 'qti_text', qti_text)
+                save_items(self.itemPath, self.items_used)
+                return
+            
             #-----------------------------------------------
-            #  3.  Loop over the versions
+            #  3.  Write the package to a temporary file in the target 
+            #      directory and rename it into place, so a partially 
+            #      written package is never left behind. 
             #-----------------------------------------------
-            for n, version in enumerate(self.q.versions):
-                
-                #-----------------------------------------------
-                #  3.a.  Process eqns in text. Add seed text.
-                #-----------------------------------------------
-                temp = self.process_equations(version['text'])
-                
-                if seeds in ['hide', 'show']:
-                    temp = temp.strip()
-                    #print(f'--{temp}--')
-                    
-                    # Remove closing paragraph tag, if present. 
-                    close_par = False
-                    if temp[-4:] == '</p>':   
-                        close_par = True
-                        temp = temp[:-4] + '\n<br/>'
-                                    
-                    if seeds == 'hide':
-                        temp += f'<span style="color:white; font-size:10px">[Version {version["version_seed"]}]</span>'
-                    if seeds == 'show':
-                        temp += f'<span style="font-size:10px">[Version {version["version_seed"]}]</span>'
-                    
-                    if close_par: temp += '\n</p>'
-                    
-                    
-                    #print(temp)                        
-                    
-                version['text_eqn_proc'] = temp
-                
-                #-----------------------------------------------
-                #  3.b.  Process equations for answers
-                #-----------------------------------------------
-                version['ans_eqn_proc'] = []
-                for i,ao in enumerate(version['answer_options']):
-                    #temp = self.processEquations(ao)
-                    temp = self.process_equations(ao)
-                    version['ans_eqn_proc'].append(temp)
-                                
-                #-----------------------------------------------
-                #  Misc Bullshit
-                #-----------------------------------------------    
-                self.qPts = '1'
-                self.qNumber= n+1
-                self.htmlText=''
+            with atomic_path(self.zipFile) as tmp_file:
+                self.write_package(tmp_file, seeds, pretty)
+            
+            # Only the items used by this export are kept. 
+            save_items(self.itemPath, self.items_used)
+            
+        
+        def write_package(self, zip_path, seeds='hide', pretty=True):
+            '''
+            Writes the QTI package to zip_path. Items are streamed into the 
+            assessment file as soon as they are built. They are not stored in the 
+            versions, so memory use does not grow with the number of versions 
+            (qti_text is rendered again if it is needed later). 
+            '''
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+                with zf.open(zip_entry(self.outFile), 'w') as f:
+                    f.write((self.header + '\n').encode('utf-8'))
+                    for n, version in enumerate(self.q.versions):
+                        qti_text = self.make_item(n, version, seeds, self.perms[n], self.letters[n])
+                        f.write((qti_text + '\n').encode('utf-8'))
+                    f.write(self.footer.encode('utf-8'))
                 
-                                
-                #-----------------------------------------------
-                #  3.c.  Call parse_type to create v['qti_text']
-                #-----------------------------------------------
-                # The function below formats text_eqn_proc and ans_eqn_proc
-                # based on question type and then creates v['qti_text]. 
-                #
-                # cur_version below is used instead of just passing version as an argument. 
-                # I should change that. This obscures the flow of the program. 
-                self.cur_version = version
-                self.parse_type()
+                # Add images and the manifest. 
+                for img_path, img_name in self.images:
+                    with open(img_path, 'rb') as img:
+                        zf.writestr(zip_entry(img_name), img.read())
                 
-                #-----------------------------------------------
-                #  3.d.  Add the question to out_file_contents
-                #-----------------------------------------------
-                out_file_contents += self.cur_version['qti_text'] + '\n'
-
-            #-----------------------------------------------
-            #  4.  Write the footer to file
-            #-----------------------------------------------                    
-            out_file_contents += self.footer
-            man_file_contents += self.manFooter
-            
-            #with self.outFile.open('a') as f:
-            #    f.write(self.footer)
-            #with self.manFile.open('a') as f:
-            #    f.write(self.manFooter)
+                with zf.open(zip_entry(self.manFile), 'w') as f:
+                    self.write_manifest(f, pretty)
             
+
+        
+        def make_item(self, n, version, seeds='hide', perm=None, letter='a'):
+            '''
+            Returns the QTI item for one version, using the item cache if enabled. 
+            '''
+            if self.item_cache is None:
+                return self.build_item(n, version, seeds, perm, letter)
+            
+            key = item_cache_key(self.qt_key, n, version, self.shuffle, seeds, perm, letter, 
+                                 self.compact, self.q.css_classes)
+            fragment = self.item_cache.get(key)
+            if fragment is None:
+                fragment = self.build_fragment(n, version, seeds, perm, letter)
+            self.items_used[key] = fragment
+            return fill_seed(fragment, seeds, version['version_seed'])
+        
+        
+        def build_fragment(self, n, version, seeds='hide', perm=None, letter='a'):
+            '''
+            Builds the item for the cache, with SEED_SLOT in place of the seed span. 
+            '''
+            if seeds in ['hide', 'show']:
+                seeds = SEED_SLOT
+            return self.build_item(n, version, seeds, perm, letter)
+        
+        
+        def build_item(self, n, version, seeds='hide', perm=None, letter='a'):
+            '''
+            Returns the QTI item for one version. n is the position of the version 
+            in the export and is used for the item identifier. perm is the order 
+            of the answer options, if shuffling, and letter is used for the item's 
+            question identifier. These come from make_shuffles. 
+            '''
             
             #-----------------------------------------------
-            #  5.  Write the contents to the files
+            #  1.  Process eqns in text. Add seed text.
             #-----------------------------------------------
-            # Write the files
-            if create_files:
-                with self.outFile.open(mode='w', encoding="utf-8") as f:
-                    f.write(out_file_contents)
-                with self.manFile.open(mode='w', encoding="utf-8") as f:
-                    f.write(man_file_contents)
-                
-                #---------------------------------------------------------------
-                #  6.  Not sure. Register names spaces? Write stuff to file?
-                #---------------------------------------------------------------
-                ET.register_namespace("", "http://www.imsglobal.org/xsd/imsccv1p1/imscp_v1p1")
-                tree = ET.parse(str(self.manFile))
-                root = tree.getroot()
-                indent(root)
-                #mydata = ET.tostring(root, encoding='utf8').decode('utf8')
-                mydata = ET.tostring(root).decode()
-
-                myfile = open(str(self.manFile), 'w')
-                myfile.write(mydata)
-                myfile.close()
-                
-                ET.register_namespace("", "http://www.imsglobal.org/xsd/ims_qtiasiv1p2")
-                tree = ET.parse(str(self.outFile))
-                root = tree.getroot()
-                #mydata = ET.tostring(root, encoding='utf8').decode('utf8')
-                mydata = ET.tostring(root).decode()
-                
-                for i in range(20):
-                    try:
-                        myfile = open(str(self.outFile), 'w')
-                        break
-                    except:
-                        time.sleep(1)
-                        
-                myfile.write(mydata)
-                myfile.close()
-            
-            
-                #---------------------------------------------------------
-                #  7.  Create zip file and delete folder w/ temp files. 
-                #---------------------------------------------------------
-                # compress the folder
-                shutil.make_archive(str(self.newDirPath), 'zip', str(self.newDirPath))
-                #remove the now compressed folder
+            # Static equations were converted when the template was parsed. 
+            fields = version['fields']
+            if static_equations_valid(fields):
+                temp = self.process_equations(join_segments(self.q.__segments__('qti_text_segments'), fields))
+                answers = [join_segments(ao, fields) for ao in self.q.qti_answer_segments]
+            else:
+                temp = self.process_equations(version['text'])
+                answers = version['answer_options']
+            
+            if seeds in ['hide', 'show', SEED_SLOT]:
+                temp = temp.strip()
                 
+                # Remove closing paragraph tag, if present. 
+                close_par = False
+                if temp[-4:] == '</p>':   
+                    close_par = True
+                    temp = temp[:-4] + '\n<br/>'
                 
-                for i in range(20):
-                    try:
-                        shutil.rmtree(str(self.newDirPath), ignore_errors=False)
-                        break
-                    except:
-                        time.sleep(1)
+                if seeds == SEED_SLOT:
+                    temp += SEED_SLOT
+                else:
+                    temp += seed_span(seeds, version['version_seed'])
                 
+                if close_par: temp += '\n</p>'
+            
+            # The stylesheet goes in every item, since an LMS may show items one at a time. 
+            if self.q.css_classes:
+                temp = self.q.__css__()['stylesheet'] + temp
+            
+            #-----------------------------------------------
+            #  2.  Process equations for answers
+            #-----------------------------------------------
+            ans_eqn_proc = [self.process_equations(ao) for ao in answers]
+                            
+            #-----------------------------------------------
+            #  Misc Bullshit
+            #-----------------------------------------------    
+            self.qPts = '1'
+            self.qNumber= n+1
+            self.htmlText=''
             
+            #-----------------------------------------------
+            #  3.  Call parse_type to create qti_text
+            #-----------------------------------------------
+            # The function below formats text_eqn_proc and ans_eqn_proc
+            # based on question type and then creates cur_version['qti_text]. 
+            # cur_version is a scratch dict so the intermediate text is not 
+            # stored on the version itself. 
+            self.cur_perm = perm
+            self.cur_letter = letter
+            self.cur_version = {
+                'version_seed': version['version_seed'],
+                'text_eqn_proc': temp,
+                'ans_eqn_proc': ans_eqn_proc,
+            }
+            self.parse_type()
+            
+            # These types are built from skeletons, which are already compact. 
+            if self.compact and self.questionType not in ['MC', 'MA', 'MT', 'NUM']:
+                return compact_xml(self.cur_version['qti_text'])
+            return self.cur_version['qti_text']
 
         
         def qHeader(self):
@@ -336,8 +610,8 @@ class makeQTI():
             # add error call if imagePath doesn't exist
             #if not imgPath.exists():
             #    errorNoImage(self.qNumber)
-            # copy the image file
-            shutil.copy(str(imgPath), str(self.newDirPath))
+            # the image file is copied into the package by run()
+            self.images.append((str(imgPath), imgpath))
             # add the info to the manifest file
             self.addResMan(imgpath)
 
@@ -374,19 +648,7 @@ class makeQTI():
             # add other question types here
         
         def processFormatting(self, text):
-            # process markdown characters
-            # process bold
-            text = re.sub(r'(\*{2}([\W\w\s]+?)\*{2})', '<strong>\\2</strong>', text)
-            # process italics
-            text = re.sub(r'(\*{1}([\W\w\s]+?)\*{1})', '<em>\\2</em>', text)
-            # process superscript
-            text = re.sub(r'(\^{1}([\W\w\s]+?)\^{1})', '<sup>\\2</sup>', text)
-            # process subscript
-            #text = re.sub(r'(\~{1}([\W\w\s]+?)\~{1})', '<sub>\\2</sub>', text)
-            # escape html characters
-            text = html.escape(text)
-            # return
-            return text
+            return process_formatting(text)
 
         def parseMC(self):
             import numpy as np
@@ -396,10 +658,9 @@ class makeQTI():
             correct = [1]
 
             if self.shuffle:
-                N = len(answers)
-                shuffled_idx = np.random.choice(range(N), size=N, replace=False)
-                answers = np.array(answers)[shuffled_idx]
-                correct = [np.argwhere(shuffled_idx == 0)[0][0] + 1]
+                perm = self.cur_perm.tolist()
+                answers = [answers[k] for k in perm]
+                correct = [perm.index(0) + 1]
             
             quest = self.processFormatting(quest)
             # make an identifier for the question
@@ -428,15 +689,9 @@ class makeQTI():
                 
             
             if self.shuffle:
-                N = len(answers)
-                shuffled_idx = np.random.choice(range(N), size=N, replace=False)
-                answers = np.array(answers)[shuffled_idx]
-                
-                shuffled_correct = []
-                for n in correct:
-                    k = np.argwhere(shuffled_idx == n-1)[0][0] + 1
-                    shuffled_correct.append(str(k))
-                correct = sorted(shuffled_correct)
+                perm = self.cur_perm.tolist()
+                answers = [answers[k] for k in perm]
+                correct = sorted(str(perm.index(n-1) + 1) for n in correct)
             
             quest = self.processFormatting(quest)
             # make an identifier for the question
@@ -1115,6 +1370,30 @@ class makeQTI():
             return out
 
 
+        #-----------------------------------------------------------
+        # Item XML. 
+        # The response XML for choice and matching questions is built 
+        # in loops, but only depends on the number of options. The 
+        # build* methods are called once per shape with slots in place 
+        # of the values (see fillSkeleton), and the resulting template 
+        # is filled in for each version. The item header and NUM 
+        # responses are single f-strings already, so they are built 
+        # directly. 
+        #-----------------------------------------------------------
+        def fillSkeleton(self, key, build, values):
+            '''
+            Returns build(values), using the template cached under key. 
+            build is called with slot markers when the template is created. 
+            '''
+            template = self.skeletons.get(key)
+            if template is None:
+                text = build(slots(len(values)))
+                if self.compact:
+                    text = compact_xml(text)
+                template = slot_template(text)
+                self.skeletons[key] = template
+            return template(values)
+        
         def questionText(self, quest, itid, orig_ans_ids = None):
             
             # build the text for each question, starting with a question "header"
@@ -1124,8 +1403,19 @@ class makeQTI():
                 &lt;p&gt;{quest}&lt;/p&gt;
                 '''
             
+            # In compact mode the text is built from a skeleton, so that the 
+            # whitespace is removed once per question rather than once per item. 
+            values = [itid, self.cur_version['version_seed'], self.qPts, self.cur_letter, quest]
+            if orig_ans_ids:
+                values.append(','.join(orig_ans_ids))
+            if self.compact:
+                key = ('text', self.questionType, len(values))
+                return self.fillSkeleton(key, lambda s: self.buildText(*s), values)
+            return self.buildText(*values)
+        
+        def buildText(self, itid, seed, pts, letter, quest, orig_ids=None):
             out1 = f'''
-            <item ident="{itid}" title="Version {self.cur_version['version_seed']}">
+            <item ident="{itid}" title="Version {seed}">
                 <itemmetadata>
                   <qtimetadata>
                     <qtimetadatafield>
@@ -1134,7 +1424,7 @@ class makeQTI():
                     </qtimetadatafield>
                     <qtimetadatafield>
                       <fieldlabel>points_possible</fieldlabel>
-                      <fieldentry>{self.qPts}</fieldentry>
+                      <fieldentry>{pts}</fieldentry>
                     </qtimetadatafield>
                     '''
             if self.questionType == 'TF':
@@ -1146,22 +1436,18 @@ class makeQTI():
                 '''
                 
             #this might be important for ordering questions
-            if orig_ans_ids:
+            if orig_ids is not None:
                 out1 += f'''
                     <qtimetadatafield>
                         <fieldlabel>original_answer_ids</fieldlabel>
-                        <fieldentry>{','.join(orig_ans_ids)}</fieldentry>
+                        <fieldentry>{orig_ids}</fieldentry>
                     </qtimetadatafield>
                 '''
             
-            import numpy as np
-            letters = list('abcdefghijklmnopqrstuvwxyz')
-            r_string = ''.join(np.random.choice(letters))
-                
             out1 += f'''
                     <qtimetadatafield>
                       <fieldlabel>assessment_question_identifierref</fieldlabel>
-                      <fieldentry>exs_{r_string}</fieldentry>
+                      <fieldentry>exs_{letter}</fieldentry>
                     </qtimetadatafield>
                   </qtimetadata>
                 </itemmetadata>
@@ -1190,6 +1476,25 @@ class makeQTI():
             
         def questionTextResponses(self, answers, corr):
             corr = [str(x) for x in corr]
+            answers = list(answers)
+            for a in range(len(answers)):
+                # check to see if it's an image
+                im = IMAGE_PATTERN.match(answers[a])
+                if im is not None:
+                    self.respImagePath = im.group(1)
+                    self.processImage(self.respImagePath)
+                    answers[a] = '''&lt;img src="%24IMS-CC-FILEBASE%24/{}" style="max-width: 100%; height: 500px" /&gt;
+                    '''.format(self.respImagePath)
+            
+            # ids of the incorrect answers, listed when there are several correct answers
+            others = [str(a+1) for a in range(len(answers)) if str(a+1) not in corr] if len(corr) > 1 else []
+            
+            N, k = len(answers), len(corr)
+            key = ('responses', self.questionType, N, k, len(others))
+            build = lambda s: self.buildResponses(s[:N], s[N:N+k], s[N+k:])
+            return self.fillSkeleton(key, build, answers + corr + others)
+        
+        def buildResponses(self, answers, corr, others):
             # set some strings based on question type
             if self.questionType == 'MC':
                 respid = 'response1'
@@ -1202,16 +1507,7 @@ class makeQTI():
               <render_choice>
             '''.format(respid, rcard,)
             #loop through answers and add
-            respList=[]
             for a in range(len(answers)):
-                # check to see if it's an image
-                im = re.findall(r'^\s*image:\s*(.*)$', answers[a])
-                if len(im)==1:
-                    self.respImagePath = im[0]
-                    self.processImage(self.respImagePath)
-                    answers[a] = '''&lt;img src="%24IMS-CC-FILEBASE%24/{}" style="max-width: 100%; height: 500px" /&gt;
-                    '''.format(self.respImagePath)
-
                 #make a string to track which answer is which
                 resp = str(a+1)
                 out1 += ''' <response_label ident="{}">
@@ -1220,7 +1516,6 @@ class makeQTI():
                         </material>
                         </response_label>
                         '''.format(resp, answers[a])
-                respList.append(resp)
             # done with answers, add stuff for end of question
             out1 += '''</render_choice>
                   </response_lid>
@@ -1242,13 +1537,12 @@ class makeQTI():
                 for ans in range(len(corr)):
                     out1 += '''<varequal respident="{}">{}</varequal>
                     '''.format(respid, corr[ans])
-                    respList.remove(corr[ans])
-                if len(respList) > 0:
+                if len(others) > 0:
                     out1 += '''<not>
                     '''
-                    for ans in range(len(respList)):
+                    for ans in range(len(others)):
                       out1 += '''<varequal respident="{}">{}</varequal>
-                      '''.format(respid, respList[ans])
+                      '''.format(respid, others[ans])
                     out1 += '''</not>
                     '''
                 out1 += '''</and>
@@ -1263,7 +1557,16 @@ class makeQTI():
             return out1
 
         def questionTextResponses_NUM(self, answer, margin):
+            eps = 1e-13
+            low = float(answer) - float(margin) - eps
+            high = float(answer) + float(margin) + eps
             
+            values = [answer, low, high]
+            if self.compact:
+                return self.fillSkeleton(('NUM',), lambda s: self.buildResponsesNUM(*s), values)
+            return self.buildResponsesNUM(*values)
+        
+        def buildResponsesNUM(self, answer, low, high):
             out1 = '''
             <response_str ident="response1" rcardinality="Single">
               <render_fib fibtype="Decimal">
@@ -1273,10 +1576,6 @@ class makeQTI():
             </presentation>
             '''
 
-            eps = 1e-13
-            low = float(answer) - float(margin) - eps
-            high = float(answer) + float(margin) + eps
-
             out1 += f'''
                 <resprocessing>
                   <outcomes>
@@ -1300,6 +1599,15 @@ class makeQTI():
             return out1
     
         def questionTextResponses_MT(self, left, right):
+            L, R = len(left), len(right)
+            values = [d['text'] for d in left.values()] + [d['text'] for d in right.values()] + [d['corr'] for d in left.values()]
+            def build(s):
+                left_slots = {k: {'text': s[i], 'corr': s[L+R+i]} for i, k in enumerate(left)}
+                right_slots = {k: {'text': s[L+j]} for j, k in enumerate(right)}
+                return self.buildResponsesMT(left_slots, right_slots)
+            return self.fillSkeleton(('MT', tuple(left), tuple(right)), build, values)
+        
+        def buildResponsesMT(self, left, right):
             output = ''
             for leftID, leftData in left.items():
                 output += '''<response_lid ident="{}">
@@ -1344,50 +1652,7 @@ class makeQTI():
             return output
         
         def process_equations(self, text):
-            
-            text = text.replace(r'\$','__DS__')
-            
-            # Replace $$...$$
-            while True:
-                if text.count('$$') < 2:
-                    break
-                i = text.index('$$')        # Find index of 1st $$
-                j = text.index('$$', i+1)   # Find index of 2nd $$
-                
-                eqn_text = text[i+2:j]
-                
-                # Not sure what this stuff is for, reall. 
-                neweq = urllib.parse.quote(eqn_text)
-                neweq = neweq.replace('%', '%25')
-                
-                new_text =  f'<img class="equation_image" title="{eqn_text}" '
-                new_text += f'src="/equation_images/{neweq}?scale=1" alt="LaTeX: {eqn_text}" '
-                new_text += f'data-equation-content="{eqn_text}" data-ignore-a11y-check="">'
-
-                text = text[:i] + new_text + text[j+2:]
-                
-            # Replace $...$
-            while True:
-                if text.count('$') < 2:
-                    break
-                i = text.index('$')        # Find index of 1st $$
-                j = text.index('$', i+1)   # Find index of 2nd $$
-                
-                eqn_text = text[i+1:j]
-                
-                # Not sure what this stuff is for, really. 
-                neweq = urllib.parse.quote(eqn_text)
-                neweq = neweq.replace('%', '%25')
-                
-                new_text =  f'<img class="equation_image" title="{eqn_text}" '
-                new_text += f'src="/equation_images/{neweq}?scale=1" alt="LaTeX: {eqn_text}" '
-                new_text += f'data-equation-content="{eqn_text}" data-ignore-a11y-check="" />'
-
-                text = text[:i] + new_text + text[j+1:]
-            
-            text = text.replace('__DS__', '$')
-            
-            return text
+            return process_equations(text)
             
         
         def DELETE_processEquations_NEW(self, text):
@@ -1464,13 +1729,8 @@ class makeQTI():
             self.data=data.split('\n\n')
         
         def addResMan(self, img):    
-            out1 = '''<resource identifier="{}" type="webcontent" href="{}">
-            <file href="{}"/>
-        </resource>
-            '''.format('pic'+ str(self.imNum), img, img)
-            #write to the manifest file
-            with self.manFile.open(mode = 'a', encoding = "utf-8") as f:
-                f.write(out1)
+            # added to the manifest by run()
+            self.resources.append(('pic'+ str(self.imNum), 'webcontent', img, img))
             
         def makeHeader(self):
             # make the header for the main xml file
@@ -1486,18 +1746,8 @@ class makeQTI():
                 <section ident="root_section">
             '''
             
-            #make the header for the manifest file
-            self.manHeader = f'''<?xml version="1.0" encoding="UTF-8"?>
-<manifest identifier="i595177d21a726452731ea55437e4c4d4" xmlns="http://www.imsglobal.org/xsd/imsccv1p1/imscp_v1p1" xmlns:lom="http://ltsc.ieee.org/xsd/imsccv1p1/LOM/resource" xmlns:imsmd="http://www.imsglobal.org/xsd/imsmd_v1p2" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.imsglobal.org/xsd/imsccv1p1/imscp_v1p1 http://www.imsglobal.org/xsd/imscp_v1p1.xsd http://ltsc.ieee.org/xsd/imsccv1p1/LOM/resource http://www.imsglobal.org/profile/cc/ccv1p1/LOM/ccv1p1_lomresource_v1p0.xsd http://www.imsglobal.org/xsd/imsmd_v1p2 http://www.imsglobal.org/xsd/imsmd_v1p2p2.xsd">
-  <metadata>
-    <schema>IMS Content</schema>
-    <schemaversion>1.1.3</schemaversion>
-  </metadata>
-  <organizations/>
-  <resources>
-    <resource identifier="{self.bankName}" type="imsqti_xmlv1p2">
-      <file href="{self.bankName}/{self.bankName}.xml"/>
-    </resource>'''
+            # the main xml file is the first resource in the manifest
+            self.resources.insert(0, (self.bankName, 'imsqti_xmlv1p2', None, f'{self.bankName}/{self.bankName}.xml'))
 
         def makeFooter(self):
             self.footer = '''
@@ -1505,11 +1755,69 @@ class makeQTI():
               </assessment>
             </questestinterop>
             '''
-            
-            self.manFooter = '''</resources>
-</manifest>
-'''
         
+        def write_manifest(self, f, pretty=True):
+            write_manifest(f, self.resources, pretty)
+        
+
+#----------------------------------------------------------------------
+# Package writing helpers. Also used by QuestionBank.generate_qti. 
+#----------------------------------------------------------------------
+
+@contextlib.contextmanager
+def atomic_path(path):
+    '''
+    Yields a temporary path in the same directory as path. The temporary file 
+    is renamed to path if the block completes and removed if it fails, so a 
+    partially written file is never left behind. 
+    '''
+    path = Path(path)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        yield tmp_path
+    except BaseException:
+        if tmp_path.exists(): tmp_path.unlink()
+        raise
+    os.replace(tmp_path, path)
+
+
+def write_manifest(f, resources, pretty=True):
+    '''
+    Writes imsmanifest.xml to the binary file object f, one element per line. 
+    resources is a list of (identifier, type, href, file) tuples. 
+    If pretty is False, no indentation or line breaks are written. 
+    '''
+    def line(depth, text):
+        if pretty:
+            text = '  ' * depth + text + '\n'
+        f.write(text.encode('utf-8'))
+    
+    schemas = ('http://www.imsglobal.org/xsd/imsccv1p1/imscp_v1p1 http://www.imsglobal.org/xsd/imscp_v1p1.xsd '
+               'http://ltsc.ieee.org/xsd/imsccv1p1/LOM/resource http://www.imsglobal.org/profile/cc/ccv1p1/LOM/ccv1p1_lomresource_v1p0.xsd '
+               'http://www.imsglobal.org/xsd/imsmd_v1p2 http://www.imsglobal.org/xsd/imsmd_v1p2p2.xsd')
+    
+    line(0, '<?xml version="1.0" encoding="UTF-8"?>')
+    line(0, '<manifest identifier="i595177d21a726452731ea55437e4c4d4" '
+            'xmlns="http://www.imsglobal.org/xsd/imsccv1p1/imscp_v1p1" '
+            'xmlns:lom="http://ltsc.ieee.org/xsd/imsccv1p1/LOM/resource" '
+            'xmlns:imsmd="http://www.imsglobal.org/xsd/imsmd_v1p2" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            f'xsi:schemaLocation="{schemas}">')
+    line(1, '<metadata>')
+    line(2, '<schema>IMS Content</schema>')
+    line(2, '<schemaversion>1.1.3</schemaversion>')
+    line(1, '</metadata>')
+    line(1, '<organizations />')
+    line(1, '<resources>')
+    for ident, rtype, href, fname in resources:
+        href = '' if href is None else f' href="{html.escape(href)}"'
+        line(2, f'<resource identifier="{html.escape(ident)}" type="{rtype}"{href}>')
+        line(3, f'<file href="{html.escape(fname)}" />')
+        line(2, '</resource>')
+    line(1, '</resources>')
+    line(0, '</manifest>')
+
+
 if __name__=="__main__":
     #parser = argparse.ArgumentParser(description="import text file to export QTI for Canvas Quiz import",epilog=__doc__)
     #parser.add_argument("ifile", nargs='+', default=None,
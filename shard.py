@@ -0,0 +1,227 @@
+import os
+import pickle
+import numpy as np
+
+from apgen.cache import template_key
+from apgen.core import duplicate_key, question_name
+
+#----------------------------------------------------------------------
+# Sharded version generation.
+#
+# Every attempt has a global index, and the seed for an attempt is
+# derived from (seed, index) alone. Shard k of K attempts the indices
+# k, k+K, k+2K, ... so shards use disjoint seed streams and need no
+# coordination beyond a shared directory for their output files.
+#
+# The merged result is the first n distinct versions in global index
+# order. A shard can stop once it holds n distinct versions of its own
+# since none of its later versions could be among the first n overall.
+# Shards may also stop earlier (see quota). The merge step checks that
+# every shard has scanned far enough before accepting a result, so the
+# final set is the same for any number of shards.
+#----------------------------------------------------------------------
+
+
+def attempt_seed(seed, index):
+    '''
+    Returns the version seed used for the attempt with the given global index.
+    '''
+    state = np.random.SeedSequence([seed, index]).generate_state(1)[0]
+    return 100000 + int(state) % 900000
+
+
+def shard_path(path, qid, shard, num_shards):
+    return os.path.join(path, f'{qid}_shard{shard:03}of{num_shards:03}.pkl')
+
+
+def generate_shard(q, path, shard, num_shards, n, seed=0, max_attempts=100_000, quota=None,
+                   prevent_duplicates=True, report_errors=False, verbose=True):
+    '''
+    Generates the versions for one shard and saves them to path.
+    If the shard file already exists, generation resumes where it stopped.
+
+    PARAMETERS
+    q            : Question object
+    path         : directory shared by all shards
+    shard        : index of this shard (0 to num_shards-1)
+    num_shards   : total number of shards
+    n            : number of versions in the final (merged) set
+    seed         : seed shared by all shards
+    max_attempts : total number of attempts shared by all shards
+    quota        : number of distinct versions after which the shard stops.
+                   Defaults to n, which guarantees the merge will succeed. Smaller
+                   values reduce work; if a shard stops too early, merge_shards
+                   reports which shards need to be resumed with a larger quota.
+    '''
+    if quota is None:
+        quota = n
+    quota = min(quota, n, q.max_versions)
+    fname = shard_path(path, question_name(q), shard, num_shards)
+
+    #-------------------------------------------------------------
+    # Load the existing shard or start a new one
+    #-------------------------------------------------------------
+    data = load_shard(fname)
+    params = {'template': template_key(q.qt), 'seed': seed, 'shard': shard,
+              'num_shards': num_shards, 'max_attempts': max_attempts,
+              'prevent_duplicates': prevent_duplicates}
+    if data is None or data['params'] != params:
+        data = {
+            'params': params,
+            'frontier': shard,      # All of this shard's indices below the frontier have been attempted
+            'exhausted': False,     # True once all indices below max_attempts have been attempted
+            'candidates': [],       # List of (index, version) pairs
+            'attempt_counts': {'success':0, 'duplicate':0, 'error':0, 'condition':0},
+            'error_log': {},
+        }
+
+    #-------------------------------------------------------------
+    # Attempt versions until the quota or attempt limit is reached
+    #-------------------------------------------------------------
+    q.attempt_counts = data['attempt_counts']
+    q.error_log = data['error_log']
+    for i, v in data['candidates']:
+        v.question = q
+    seen = {duplicate_key(v) for i, v in data['candidates']}
+
+    np_state = np.random.get_state()
+    index = data['frontier']
+    while len(data['candidates']) < quota and index < max_attempts:
+        version = q.generate_one(attempt_seed(seed, index), report_errors)
+        index += num_shards
+
+        if version['status'] != 'Success':
+            continue
+
+        if prevent_duplicates:
+            key = duplicate_key(version)
+            if key in seen:
+                q.attempt_counts['duplicate'] += 1
+                continue
+            seen.add(key)
+
+        q.attempt_counts['success'] += 1
+        data['candidates'].append((index - num_shards, version))
+    np.random.set_state(np_state)
+
+    data['frontier'] = index
+    data['exhausted'] = index >= max_attempts
+    save_shard(fname, data)
+
+    if verbose:
+        print(f'{question_name(q):<24}  -- shard {shard+1:>3}/{num_shards:<3}  -- {len(data["candidates"]):>5} versions')
+
+
+def load_shard(fname):
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_shard(fname, data):
+    # Write to a temporary file and rename so a partially written shard is never read.
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        pickle.dump(data, f)
+    os.replace(tmp_fname, fname)
+
+
+def merge_shards(q, path, num_shards, n, prevent_duplicates=True):
+    '''
+    Combines the shard outputs into the final set of versions, which are
+    stored in q.versions. Raises an error if any shard is missing or has not
+    attempted enough versions for the result to be determined.
+    '''
+
+    #-------------------------------------------------------------
+    # Load the shards
+    #-------------------------------------------------------------
+    name = question_name(q)
+    shards = []
+    for k in range(num_shards):
+        data = load_shard(shard_path(path, name, k, num_shards))
+        if data is None:
+            raise FileNotFoundError(f'Shard {k} of {num_shards} for {name} was not found in {path}.')
+        shards.append(data)
+
+    params = [{k:v for k,v in s['params'].items() if k != 'shard'} for s in shards]
+    if any(p != params[0] for p in params):
+        raise ValueError(f'Shards for {name} were generated with different settings.')
+    if params[0]['template'] != template_key(q.qt):
+        raise ValueError(f'Shards for {name} were generated from a different template.')
+
+    #-------------------------------------------------------------
+    # Every index below the cutoff has been attempted by some shard
+    #-------------------------------------------------------------
+    max_attempts = params[0]['max_attempts']
+    cutoff = min([s['frontier'] for s in shards if not s['exhausted']], default=max_attempts)
+
+    #-------------------------------------------------------------
+    # Select the first n distinct versions in index order
+    #-------------------------------------------------------------
+    candidates = sorted((c for s in shards for c in s['candidates']), key=lambda c: c[0])
+    versions = []
+    seen = set()
+    duplicates = 0
+    for index, version in candidates:
+        if index >= cutoff or len(versions) == n:
+            break
+        version.question = q
+        if prevent_duplicates:
+            key = duplicate_key(version)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+        versions.append(version)
+
+    if len(versions) < n and cutoff < max_attempts:
+        behind = [k for k, s in enumerate(shards) if not s['exhausted'] and s['frontier'] == cutoff]
+        raise RuntimeError(f'Only {len(versions)} of {n} versions could be determined. '
+                           f'Resume shards {behind} with a larger quota.')
+
+    #-------------------------------------------------------------
+    # Store the results in the question
+    #-------------------------------------------------------------
+    q.versions = versions
+    q.num_attempts = sum((s['frontier'] - s['params']['shard']) // num_shards for s in shards)
+    q.attempt_counts = {'success':len(versions), 'duplicate':duplicates, 'error':0, 'condition':0}
+    q.error_log = {}
+    for s in shards:
+        for k in ['duplicate', 'error', 'condition']:
+            q.attempt_counts[k] += s['attempt_counts'][k]
+        for e, v in s['error_log'].items():
+            if e not in q.error_log: q.error_log[e] = {'count':0, 'seeds':[]}
+            q.error_log[e]['count'] += v['count']
+            q.error_log[e]['seeds'].extend(v['seeds'])
+    q.__finalize_versions__()
+
+    return versions
+
+
+if __name__ == '__main__':
+    import argparse
+    from apgen.core import Question
+
+    parser = argparse.ArgumentParser(description='Sharded version generation for a question template.')
+    parser.add_argument('command', choices=['generate', 'merge'])
+    parser.add_argument('template', help='path to the question template')
+    parser.add_argument('path', help='directory shared by all shards')
+    parser.add_argument('-n', type=int, required=True, help='number of versions in the merged set')
+    parser.add_argument('--num-shards', type=int, required=True)
+    parser.add_argument('--shard', type=int, help='shard to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-attempts', type=int, default=100_000)
+    parser.add_argument('--quota', type=int, default=None)
+    args = parser.parse_args()
+
+    q = Question(file=args.template)
+    if args.command == 'generate':
+        generate_shard(q, args.path, args.shard, args.num_shards, args.n, seed=args.seed,
+                       max_attempts=args.max_attempts, quota=args.quota)
+    else:
+        versions = merge_shards(q, args.path, args.num_shards, args.n)
+        name = question_name(q)
+        save_shard(os.path.join(args.path, f'{name}_merged.pkl'), versions)
+        print(f'{name:<24}  -- {len(versions):>5} versions merged')
@@ -0,0 +1,19 @@
+#----------------------------------------------------------------------
+# The repository is the apgen package itself. If it has not been 
+# installed, it is imported from this checkout. 
+#----------------------------------------------------------------------
+import importlib.util
+import os
+import sys
+
+if 'apgen' not in sys.modules:
+    try:
+        import apgen
+    except ImportError:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        spec = importlib.util.spec_from_file_location(
+            'apgen', os.path.join(root, '__init__.py'), submodule_search_locations=[root]
+        )
+        apgen = importlib.util.module_from_spec(spec)
+        sys.modules['apgen'] = apgen
+        spec.loader.exec_module(apgen)
@@ -0,0 +1,106 @@
+import io
+import contextlib
+
+from apgen import Question, QuestionBank
+
+
+MC = '''
+#---CONFIG---#
+id = bank_mc
+type = MC
+
+#---VARIABLES---#
+a = RANGE(2, 9, 1)
+b = RANGE(1, 50, 1)
+x = a * b
+
+#---DISTRACTORS---#
+d1 = x + 1
+d2 = x - 1
+d3 = x * 2
+
+#---CONDITIONS---#
+a != b
+
+#---TEXT---#
+What is [[a]] times [[b]]?
+
+#---ANSWER_OPTIONS---#
+[[x]]
+[[d1]]
+[[d2]]
+[[d3]]
+'''
+
+NUM = '''
+#---CONFIG---#
+id = bank_num
+type = NUM
+
+#---VARIABLES---#
+a = RANGE(1, 60, 1)
+
+#---CONDITIONS---#
+a % 3 == 0
+
+#---TEXT---#
+What is [[a]] squared?
+
+#---ANSWER_OPTIONS---#
+[[a**2]]
+'''
+
+# Only 3 distinct versions
+SMALL = NUM.replace('id = bank_num', 'id = bank_small').replace('RANGE(1, 60, 1)', 'RANGE(1, 3, 1)').replace('a % 3 == 0', 'a > 0')
+
+# Variables that cannot be pickled
+LAMBDA = NUM.replace('id = bank_num', 'id = bank_lambda').replace('a = RANGE(1, 60, 1)', 'a = RANGE(1, 60, 1)\nf = lambda t: t + 1')
+
+
+def generate(templates, **kwargs):
+    questions = [Question(qt=qt) for qt in templates]
+    bank = QuestionBank(questions)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bank.generate(**kwargs)
+    return questions, bank
+
+
+def texts(questions):
+    return [[v['text'] for v in q.versions] for q in questions]
+
+
+def test_counts_add_up():
+    questions, bank = generate([MC, NUM], n=8, seed=1, workers=0, batch_size=5)
+    for q, r in zip(questions, bank.summary):
+        assert len(q.versions) == 8
+        assert sum(q.attempt_counts.values()) == q.num_attempts
+        assert r['complete']
+
+
+def test_first_batch_not_oversized():
+    questions, bank = generate([MC], n=10, seed=1, workers=0, batch_size=50, prevent_duplicates=False)
+    # MC rejects about 1 in 8 attempts (a == b). 
+    assert questions[0].num_attempts < 15
+    assert bank.summary[0]['acceptance'] > 0.7
+
+
+def test_workers_do_not_change_versions():
+    local, _ = generate([MC, NUM, SMALL], n=[12, 12, 3], seed=4, workers=0, batch_size=5)
+    pooled, _ = generate([MC, NUM, SMALL], n=[12, 12, 3], seed=4, workers=2, batch_size=3)
+    assert texts(local) == texts(pooled)
+
+
+def test_unpicklable_versions_fall_back():
+    local, _ = generate([LAMBDA, NUM], n=6, seed=2, workers=0)
+    pooled, _ = generate([LAMBDA, NUM], n=6, seed=2, workers=2)
+    assert [len(q.versions) for q in pooled] == [6, 6]
+    assert texts(local) == texts(pooled)
+
+
+def test_question_attempts_limit():
+    questions, bank = generate([SMALL, NUM], n=[10, 5], seed=3, workers=0, question_attempts=200)
+    small, num = questions
+    assert len(small.versions) == 3
+    assert small.num_attempts <= 200
+    assert not bank.summary[0]['complete']
+    assert len(num.versions) == 5
@@ -0,0 +1,58 @@
+import io
+import contextlib
+import marshal
+import os
+
+from apgen import Question
+from apgen.cache import CACHE_EXT, CACHE_FORMAT, load_compiled, save_compiled, template_key
+
+
+TEMPLATE = '''
+#---CONFIG---#
+id = cache_test
+type = NUM
+
+#---VARIABLES---#
+a = RANGE(2, 9, 1)
+
+#---TEXT---#
+What is [[a]] squared?
+
+#---ANSWER_OPTIONS---#
+[[a**2]]
+'''
+
+
+def generate(q):
+    with contextlib.redirect_stdout(io.StringIO()):
+        q.generate(n=3, seed=1)
+    return [v['text'] for v in q.versions]
+
+
+def test_cached_template_matches(tmp_path):
+    first = Question(qt=TEMPLATE, cache_dir=str(tmp_path))
+    assert load_compiled(first.qt, str(tmp_path)) is not None
+    second = Question(qt=TEMPLATE, cache_dir=str(tmp_path))
+    assert generate(first) == generate(second)
+
+
+def test_entries_from_other_formats_are_misses(tmp_path):
+    q = Question(qt=TEMPLATE, cache_dir=str(tmp_path))
+    path = os.path.join(str(tmp_path), template_key(q.qt) + CACHE_EXT)
+    
+    # An entry without a format, as written before formats were stored. 
+    with open(path, 'wb') as f:
+        f.write(marshal.dumps({'type': 'NUM'}))
+    assert load_compiled(q.qt, str(tmp_path)) is None
+    
+    # An entry from a different format. 
+    save_compiled(q.qt, {'type': 'NUM'}, str(tmp_path))
+    with open(path, 'rb') as f:
+        fmt, state = marshal.loads(f.read())
+    assert fmt == CACHE_FORMAT
+    with open(path, 'wb') as f:
+        f.write(marshal.dumps((CACHE_FORMAT - 1, state)))
+    assert load_compiled(q.qt, str(tmp_path)) is None
+    
+    # Stale entries are replaced when the template is compiled again. 
+    assert generate(Question(qt=TEMPLATE, cache_dir=str(tmp_path))) == generate(q)
@@ -0,0 +1,62 @@
+import numpy as np
+
+from apgen.core import compile_format, format_column
+
+
+def check(values, formatting=None):
+    formatter = compile_format(formatting)
+    assert format_column(values, formatting) == [formatter(v) for v in values]
+
+
+def test_float32_column():
+    values = np.array([8.8, 0.1, -2.25, 3.0], dtype=np.float32)
+    assert format_column(values) == ['8.8', '0.1', '-2.25', '3.0']
+    for fmt in [None, '0', '2', '5']:
+        check(values, fmt)
+
+
+def test_near_zero_negative_column():
+    values = np.array([0.3 - 0.1 - 0.2, -1e-12, -0.0, 1e-11, 0.1 + 0.2])
+    assert format_column(values, '2')[:3] == ['0.00', '0.00', '0.00']
+    assert format_column(values)[:3] == ['0', '0', '0']
+    for fmt in [None, '0', '2', '9']:
+        check(values, fmt)
+
+
+def test_random_columns():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(-1, 1, 2000) * 10.0 ** rng.integers(-15, 3, 2000)
+    for fmt in [None, '0', '2', '5']:
+        check(values, fmt)
+
+
+BIG = '''
+#---CONFIG---#
+id = big_ints
+type = NUM
+
+#---VARIABLES---#
+a = int(RANGE(1, 9, 1)) * 10**9
+b = int(RANGE(2, 5, 1))
+
+#---TEXT---#
+[[a*a]] and [[a**b]] and [[(a**3)//(a**2)]] and [[a+b]]
+
+#---ANSWER_OPTIONS---#
+[[a*b]]
+'''
+
+
+def test_int_overflow_matches_versions():
+    import io
+    import contextlib
+    from apgen import Question
+    
+    q = Question(qt=BIG)
+    with contextlib.redirect_stdout(io.StringIO()):
+        q.generate(n=8, seed=1, prevent_duplicates=False)
+    texts, answers = q.render_columns(q.version_table())
+    assert texts == [v['text'] for v in q.versions]
+    assert answers == [v['answer_options'] for v in q.versions]
+    # Some of the products do not fit in an int64. 
+    assert any(v['var_defns']['a'] ** 2 >= 2**63 for v in q.versions)
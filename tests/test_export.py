@@ -0,0 +1,65 @@
+import io
+import contextlib
+import os
+
+from apgen import Question
+from apgen.cache import template_key
+
+
+TEMPLATE = '''
+#---CONFIG---#
+id = export_test
+type = NUM
+
+#---VARIABLES---#
+a = RANGE(2, 9, 1)
+
+#---TEXT---#
+What is $[[a]]^2$? It costs \\$5.
+
+#---ANSWER_OPTIONS---#
+[[a**2]]
+'''
+
+
+def make_question(qt=TEMPLATE, n=5):
+    q = Question(qt=qt)
+    with contextlib.redirect_stdout(io.StringIO()):
+        q.generate(n=n, seed=1, prevent_duplicates=False)
+    return q
+
+
+def export(q, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return q.export_html(*args, **kwargs)
+
+
+def test_export_html(tmp_path):
+    q = make_question()
+    files = export(q, str(tmp_path / 'out.html'))
+    assert files == [str(tmp_path / 'out.html')]
+    with open(files[0]) as f:
+        page = f.read()
+    assert page.count('katex.min.js') == 1
+    assert page.count('renderMathInElement(document.body)') == 1
+    assert page.count('<b><font size=4>Version') == 5
+    assert '__EQN__' in page and '$5' in page
+
+
+def test_export_html_split(tmp_path):
+    q = make_question(n=7)
+    files = export(q, str(tmp_path / 'out.html'), versions_per_file=3)
+    assert [os.path.basename(f) for f in files] == ['out_01.html', 'out_02.html', 'out_03.html']
+    counts = []
+    for fname in files:
+        with open(fname) as f:
+            counts.append(f.read().count('<b><font size=4>Version'))
+    assert counts == [3, 3, 1]
+
+
+def test_export_html_without_id(tmp_path, monkeypatch):
+    q = make_question(TEMPLATE.replace('id = export_test\n', ''))
+    monkeypatch.chdir(tmp_path)
+    files = export(q)
+    assert files == [f'{template_key(q.qt)}.html']
+    assert os.path.exists(str(tmp_path / files[0]))
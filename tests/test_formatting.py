@@ -0,0 +1,16 @@
+import numpy as np
+
+from apgen.core import compile_format, format_value
+
+
+def test_float32_uses_numpy_str():
+    assert format_value(np.float32(8.8)) == '8.8'
+    assert format_value(np.float32(8.8), '2') == '8.80'
+    assert format_value(np.float32(3.0), ',') == '3.0'
+    assert format_value(np.float16(0.5)) == '0.5'
+
+
+def test_float64_is_rounded():
+    assert format_value(0.1 + 0.2) == '0.3'
+    assert format_value(np.float64(2.0)) == '2'
+    assert format_value(0.3 - 0.1 - 0.2, '2') == '0.00'
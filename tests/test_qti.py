@@ -0,0 +1,156 @@
+import io
+import contextlib
+import zipfile
+
+from apgen import Question
+
+
+TEMPLATE = '''
+#---CONFIG---#
+id = qti_test
+type = MC
+
+#---VARIABLES---#
+a = RANGE(2, 20, 1)
+b = RANGE(2, 20, 1)
+
+#---DISTRACTORS---#
+d1 = a * b + 1
+d2 = a * b - 1
+d3 = a + b
+
+#---TEXT---#
+What is $[[a]] \\times [[b]]$?
+
+#---ANSWER_OPTIONS---#
+[[a*b]]
+[[d1]]
+[[d2]]
+[[d3]]
+'''
+
+
+def make_question(n=5):
+    q = Question(qt=TEMPLATE)
+    with contextlib.redirect_stdout(io.StringIO()):
+        q.generate(n=n, seed=1)
+    return q
+
+
+def read_package(path, name):
+    with zipfile.ZipFile(str(path / f'{name}_export.zip')) as zf:
+        return zf.read(f'{name}/{name}.xml').decode('utf-8')
+
+
+def test_export_does_not_store_items(tmp_path):
+    q = make_question()
+    with contextlib.redirect_stdout(io.StringIO()):
+        q.generate_qti(path=str(tmp_path), shuffle_seed=1)
+    assert not any(dict.__contains__(v, 'qti_text') for v in q.versions)
+    
+    # Items rendered afterwards match the package. 
+    xml = read_package(tmp_path, 'qti_test')
+    assert all(v['qti_text'] in xml for v in q.versions)
+
+
+def make_bank(n=4, drop_id=False):
+    from apgen import QuestionBank
+    
+    questions = [Question(qt=TEMPLATE), Question(qt=TEMPLATE.replace('id = qti_test', 'id = qti_other'))]
+    if drop_id:
+        del questions[1].id
+    bank = QuestionBank(questions)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bank.generate(n=n, seed=2, workers=0)
+    return bank
+
+
+def test_bank_export(tmp_path):
+    bank = make_bank()
+    with contextlib.redirect_stdout(io.StringIO()):
+        bank.generate_qti(path=str(tmp_path), name='bank', pick=[1, 2], shuffle_seed=3, workers=0)
+    xml = read_package(tmp_path, 'bank')
+    assert xml.count('<item ') == 8
+    assert xml.count('<section ident="group_') == 2
+    assert '<selection_number>2</selection_number>' in xml
+    
+    # Worker processes build the same package. 
+    with contextlib.redirect_stdout(io.StringIO()):
+        bank.generate_qti(path=str(tmp_path), name='pooled', pick=[1, 2], shuffle_seed=3, workers=2, batch_size=3)
+    assert read_package(tmp_path, 'pooled').replace('pooled', 'bank') == xml
+
+
+def test_bank_export_without_id(tmp_path):
+    bank = make_bank(drop_id=True)
+    cache_dir = str(tmp_path / 'cache')
+    with contextlib.redirect_stdout(io.StringIO()):
+        bank.generate_qti(path=str(tmp_path), name='bank', shuffle_seed=3, workers=0, cache_dir=cache_dir)
+    assert read_package(tmp_path, 'bank').count('<item ') == 8
+
+
+def count_builds(monkeypatch):
+    from apgen.qti_convert import makeQTI
+    
+    calls = []
+    build_item = makeQTI.build_item
+    def counting(self, *args, **kwargs):
+        calls.append(args[0])
+        return build_item(self, *args, **kwargs)
+    monkeypatch.setattr(makeQTI, 'build_item', counting)
+    return calls
+
+
+def export(q, path, cache_dir, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        q.generate_qti(path=str(path), cache_dir=cache_dir, **kwargs)
+    return read_package(path, q.id)
+
+
+def test_item_cache_hit_and_miss(tmp_path, monkeypatch):
+    from apgen.cache import item_cache_path, load_items
+    
+    calls = count_builds(monkeypatch)
+    cache_dir = str(tmp_path / 'cache')
+    q = make_question()
+    
+    first = export(q, tmp_path, cache_dir, shuffle_seed=1)
+    assert len(calls) == 5
+    assert len(load_items(item_cache_path('qti_test', cache_dir))) == 5
+    
+    # Nothing has changed, so every item comes from the cache. 
+    del calls[:]
+    assert export(q, tmp_path, cache_dir, shuffle_seed=1) == first
+    assert len(calls) == 0
+    
+    # The seed is filled in when items are written, so showing it is still a hit. 
+    shown = export(q, tmp_path, cache_dir, shuffle_seed=1, seeds='show')
+    assert len(calls) == 0
+    assert shown != first
+    
+    # A different shuffle changes every item. 
+    export(q, tmp_path, cache_dir, shuffle_seed=2)
+    assert len(calls) == 5
+    
+    # Only the items used by the last export are kept. 
+    assert len(load_items(item_cache_path('qti_test', cache_dir))) == 5
+
+
+def test_item_cache_invalidation(tmp_path, monkeypatch):
+    calls = count_builds(monkeypatch)
+    cache_dir = str(tmp_path / 'cache')
+    q = make_question()
+    first = export(q, tmp_path, cache_dir, shuffle_seed=1)
+    
+    # Editing the template invalidates its items, even with the same id and versions. 
+    edited = Question(qt=TEMPLATE.replace('What is', 'Compute'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        edited.generate(n=5, seed=1)
+    del calls[:]
+    xml = export(edited, tmp_path, cache_dir, shuffle_seed=1)
+    assert len(calls) == 5
+    assert 'Compute' in xml and xml != first
+    
+    # Compact output is cached separately. 
+    del calls[:]
+    export(edited, tmp_path, cache_dir, shuffle_seed=1, compact=True)
+    assert len(calls) == 5
@@ -0,0 +1,78 @@
+import io
+import contextlib
+import os
+
+import pytest
+
+from apgen import Question
+from apgen.cache import template_key
+from apgen.shard import generate_shard, merge_shards
+
+
+TEMPLATE = '''
+#---CONFIG---#
+id = shard_test
+type = NUM
+
+#---VARIABLES---#
+a = RANGE(1, 40, 1)
+b = RANGE(1, 5, 1)
+
+#---CONDITIONS---#
+a % 2 == 0
+
+#---TEXT---#
+What is [[a]] times [[b]]?
+
+#---ANSWER_OPTIONS---#
+[[a*b]]
+'''
+
+NO_ID = TEMPLATE.replace('id = shard_test\n', '')
+
+
+def run(qt, path, num_shards, n, quota=None):
+    os.makedirs(str(path), exist_ok=True)
+    q = Question(qt=qt)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for k in range(num_shards):
+            generate_shard(q, str(path), k, num_shards, n, seed=5, quota=quota)
+    return q, merge_shards(q, str(path), num_shards, n)
+
+
+def seeds(versions):
+    return [v['version_seed'] for v in versions]
+
+
+def test_same_versions_for_any_number_of_shards(tmp_path):
+    results = []
+    for num_shards in [1, 2, 3, 7]:
+        q, versions = run(TEMPLATE, tmp_path / str(num_shards), num_shards, 12)
+        assert len(versions) == 12
+        assert q.versions == versions
+        results.append(seeds(versions))
+    assert all(r == results[0] for r in results)
+
+
+def test_small_quota_reports_shards_to_resume(tmp_path):
+    q = Question(qt=TEMPLATE)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for k in range(3):
+            generate_shard(q, str(tmp_path), k, 3, 12, seed=5, quota=1)
+    with pytest.raises(RuntimeError, match='Resume shards'):
+        merge_shards(q, str(tmp_path), 3, 12)
+    
+    # Resuming with the default quota completes the merge. 
+    with contextlib.redirect_stdout(io.StringIO()):
+        for k in range(3):
+            generate_shard(q, str(tmp_path), k, 3, 12, seed=5)
+    assert len(merge_shards(q, str(tmp_path), 3, 12)) == 12
+
+
+def test_template_without_id(tmp_path):
+    q, versions = run(NO_ID, tmp_path, 2, 5)
+    assert not hasattr(q, 'id')
+    assert len(versions) == 5
+    _, expected = run(TEMPLATE, tmp_path / 'with_id', 2, 5)
+    assert seeds(versions) == seeds(expected)
+    assert os.path.exists(str(tmp_path / f'{template_key(q.qt)}_shard000of002.pkl'))
@@ -0,0 +1,46 @@
+import io
+import contextlib
+
+from apgen import Question
+from apgen.core import split_table_row
+
+
+TEMPLATE = '''
+#---CONFIG---#
+id = table_test
+type = NUM
+
+#---VARIABLES---#
+a = RANGE(2, 9, 1)
+
+#---TEXT---#
+TABLE
+| A | B |
+| x \\| y | $\\|v\\|$ |
+| [[a]] | $|[[a]]|$ |
+cw: 60; align: C
+END TABLE
+
+#---ANSWER_OPTIONS---#
+[[a]]
+'''
+
+
+def test_split_on_pipes():
+    assert split_table_row('| a | b |') == ['', ' a ', ' b ', '']
+    assert split_table_row('| $|x|$ | [[ f(x) | 1 ]] |') == ['', ' $|x|$ ', ' [[ f(x) | 1 ]] ', '']
+
+
+def test_escaped_pipe():
+    assert split_table_row(r'| a \| b | c |') == ['', ' a | b ', ' c ', '']
+    assert split_table_row(r'| $\|x\|$ | c |') == ['', r' $\|x\|$ ', ' c ', '']
+
+
+def test_escaped_pipe_in_question():
+    q = Question(qt=TEMPLATE)
+    with contextlib.redirect_stdout(io.StringIO()):
+        q.generate(n=1, seed=1)
+    text = q.versions[0]['text']
+    assert 'x | y' in text
+    assert r'x \| y' not in text
+    assert r'$\|v\|$' in text
@@ -0,0 +1,107 @@
+import io
+import contextlib
+import pickle
+
+from apgen import Question
+
+
+TEMPLATE = '''
+#---CONFIG---#
+id = version_test
+type = MC
+
+#---VARIABLES---#
+a = RANGE(2, 20, 1)
+b = RANGE(2, 20, 1)
+
+#---DISTRACTORS---#
+d1 = a * b + 1
+d2 = a * b - 1
+d3 = a + b
+
+#---TEXT---#
+What is $[[a]] \\times [[b]]$?
+
+#---ANSWER_OPTIONS---#
+[[a*b]]
+[[d1]]
+[[d2]]
+[[d3]]
+'''
+
+
+def make_question(n=5, text_cache_size=None):
+    q = Question(qt=TEMPLATE)
+    q.text_cache_size = text_cache_size
+    with contextlib.redirect_stdout(io.StringIO()):
+        q.generate(n=n, seed=1)
+    return q
+
+
+def test_text_is_rendered_lazily():
+    q = make_question()
+    v = q.versions[0]
+    assert 'text' not in dict(v)
+    text = v['text']
+    assert str(v['var_defns']['a']) in text
+    assert dict.__getitem__(v, 'text') is text
+    assert v['colab_text'] == text.replace('$', '__EQN__')
+
+
+def test_cache_is_bounded():
+    q = make_question(n=6, text_cache_size=2)
+    texts = [v['text'] for v in q.versions]
+    cached = [v for v in q.versions if dict.__contains__(v, 'text')]
+    assert cached == q.versions[-2:]
+    
+    # Evicted text is rendered again, with the same result. 
+    assert [v['text'] for v in q.versions] == texts
+
+
+def test_assigned_text_is_kept():
+    for size in [0, 1, None]:
+        q = make_question(n=3, text_cache_size=size)
+        q.versions[0]['text'] = 'EDITED'
+        for v in q.versions:
+            v['text'], v['answer_options']
+        assert q.versions[0]['text'] == 'EDITED'
+        q.versions[0].clear_text()
+        assert q.versions[0]['text'] == 'EDITED'
+
+
+def test_pickling_drops_question():
+    q = make_question()
+    v = q.versions[0]
+    text = v['text']
+    copy = pickle.loads(pickle.dumps(v))
+    assert copy.question is None
+    assert 'text' not in dict(copy)
+    assert copy['fields'] == v['fields']
+    
+    # The text is rendered again once the question is reattached. 
+    q.versions[0] = copy
+    q.__finalize_versions__()
+    assert copy.question is q
+    assert copy.index == 0
+    assert copy['text'] == text
+
+
+def test_pickling_keeps_assigned_text():
+    q = make_question()
+    q.versions[1]['text'] = 'EDITED'
+    copy = pickle.loads(pickle.dumps(q.versions[1]))
+    copy.question = q
+    assert copy['text'] == 'EDITED'
+    assert copy.edited == {'text'}
+
+
+def test_qti_text_uses_one_convertor():
+    q = make_question(n=4)
+    items = [v['qti_text'] for v in q.versions]
+    convertor = q.qti_convertor
+    assert [v['qti_text'] for v in q.versions] == items
+    for v in q.versions:
+        v.clear_text()
+    assert [v['qti_text'] for v in q.versions] == items
+    assert q.qti_convertor is convertor
+    assert all(f'{v["version_seed"]}' in item for v, item in zip(q.versions, items))